@@ -4,6 +4,8 @@ import os
 import warnings
 import traceback
 from file_manager import FileSystemManager
+from grammar import GrammarCache
+from jobs import JobQueue, QueueFull
 from flask import Flask, flash, request, redirect, url_for, render_template, send_from_directory, jsonify
 from werkzeug.utils import secure_filename
 from io_utils import read_textfile
@@ -30,8 +32,20 @@ app.secret_key = secret_key
 
 manager = FileSystemManager(
     zip_dir=app.config['ZIP_DIR'],
-    extracted_dir=app.config["EXTRACTED_DIR"],
     download_dir=app.config["DOWNLOAD_DIR"],
+    workers=app.config.get("WORKERS", 1),
+    max_member_size=app.config.get("MAX_MEMBER_SIZE", 64 * 2 ** 20),
+    grammar_cache=GrammarCache(
+        app.config["GRAMMAR_CACHE_DIR"],
+        max_bytes=app.config.get("GRAMMAR_CACHE_MAX_BYTES", 256 * 2 ** 20),
+        ttl=app.config.get("GRAMMAR_CACHE_TTL", 30 * 24 * 3600),
+    ) if app.config.get("GRAMMAR_CACHE_DIR") else None,
+)
+
+jobs = JobQueue(
+    concurrency=app.config.get("JOB_CONCURRENCY", 1),
+    max_queued=app.config.get("JOB_QUEUE_DEPTH", 8),
+    keep=app.config.get("JOB_HISTORY", 100),
 )
 
 
@@ -85,20 +99,41 @@ def upload_file_and_check():
             check_grammar = request.form.get('check_grammar', False)
 
             filename = file.filename.split('/')[-1]
-            download_name = manager.handle(
-                file=file,
-                filename=filename,
-                pre_para_id=pre_para_id,
-                check=check_error,
-                post_processors=post_processors,
-                lang=lang if check_grammar else None,
-                new_words=request.form.get('new_words', ''),
-            )
-            return redirect(url_for('download_file', filename=download_name))
+            # the upload is saved right away, and generated in the background; the same upload with the same options
+            # is only generated once, however many times it is submitted
+            try:
+                found, job = manager.submit(
+                    jobs, file, filename,
+                    pre_para_id=pre_para_id,
+                    check=check_error,
+                    post_processors=post_processors,
+                    lang=lang if check_grammar else None,
+                    new_words=request.form.get('new_words', ''),
+                )
+            except QueueFull:
+                flash('Too many letters are being generated right now; please try again in a few minutes',
+                      category="warning")
+                return render_template('upload.html'), 503
+            if found is not None:
+                return redirect(url_for('download_file', filename=found))
+            return redirect(url_for('job_status', job_id=job.id))
 
     return render_template('upload.html')
 
 
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': f'No such job: {job_id}'}), 404
+    status = job.to_dict()
+    if status['state'] == 'done':
+        status['download_url'] = url_for('download_file', filename=status['result'])
+    if request.args.get('format') == 'json' or request.accept_mimetypes.best == 'application/json':
+        return jsonify(status)
+    return render_template('job.html', job=status)
+
+
 @app.errorhandler(500)
 def internal_server_error(error):
     tb_str = str(traceback.format_exc())
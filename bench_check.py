@@ -0,0 +1,58 @@
+"""
+Checking throughput: `Controller.check_all` over a synthetic batch on 1, 2, 4 and 8 worker processes.
+
+    python bench_check.py [--letters 10000] [--workers 1 2 4 8] [--whole]
+
+The letters are generated and rendered once, every tenth one gets another student's name slipped in so that there
+are findings to merge, and only the checking is timed. The findings of every run are compared to the first one's.
+A single process checks the letters piece by piece (see `PieceCache`), unless `--whole`.
+"""
+import argparse
+import contextlib
+import io
+import os
+import tempfile
+import time
+from fixtures import make_project
+from fetcher import FlockFetcher, ProjectInfoFetcher, StudentFetcher, GenreFormer
+from controller import Controller
+
+
+def check(controller, texts, workers, findings_path):
+    checkers = controller.get_checkers(findings_path=findings_path)
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        controller.check_all(checkers, texts, workers=workers)
+    elapsed = time.perf_counter() - start
+    checkers['summarizer'].close()
+    with open(findings_path) as f:
+        return elapsed, checkers['summarizer'].total, f.read()
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--letters', default=10000, type=int)
+    arg_parser.add_argument('--workers', default=[1, 2, 4, 8], type=int, nargs='+')
+    arg_parser.add_argument('--whole', action='store_true')
+    args = arg_parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        make_project(root, args.letters)
+        controller = Controller(
+            genre_former=GenreFormer(os.path.join(root, "genre")),
+            student_fetcher=StudentFetcher(root, "eval.csv", FlockFetcher(os.path.join(root, "flock"))),
+            program_fetcher=ProjectInfoFetcher(os.path.join(root, "program_info")),
+            seed=0,
+        )
+        with contextlib.redirect_stdout(io.StringIO()):
+            texts = [(row, content + " First0 Last1", pieces + [(" First0 Last1", True)]) if i % 10 == 0 else
+                     (row, content, pieces) for i, (row, content, pieces) in enumerate(controller.iter_pieces())]
+        if args.whole:
+            texts = [(row, content) for row, content, _ in texts]
+
+        expected = None
+        for workers in args.workers:
+            elapsed, total, findings = check(controller, texts, workers, os.path.join(root, "findings.jsonl"))
+            expected = expected or findings
+            print(f"workers {workers}: {elapsed:.2f}s, {total} findings, "
+                  f"{'same as' if findings == expected else 'DIFFERENT from'} workers {args.workers[0]}")
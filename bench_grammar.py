@@ -0,0 +1,46 @@
+"""
+Grammar-check throughput against the LanguageTool stub server.
+
+    python bench_grammar.py [--letters 200] [--latency 0.05]
+
+Times checking the letters one at a time with `LanguageTool.check`, and with a `GrammarChecker` at increasing
+concurrency; the stub answers each request after `latency` seconds, like a busy remote server would. Then counts
+the requests it takes to check the letters whole, and split into distinct paragraphs or sentences.
+"""
+import argparse
+import time
+import language_tool_python as langtool
+from langtool_stub import StubServer
+from grammar import GrammarChecker
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--letters', default=200, type=int)
+    arg_parser.add_argument('--latency', default=0.05, type=float)
+    args = arg_parser.parse_args()
+
+    server = StubServer(latency=args.latency).start()
+    tool = langtool.LanguageTool('en-US', remote_server=server.url)
+    names = [(f"Ada{i}", "Lovelace") for i in range(args.letters)]
+    texts = [f"Dear committee,\n\nIt is my pleasure to recommend {first} {last}. teh student did did well.\n" * 5
+             for first, last in names]
+
+    start = time.perf_counter()
+    for text in texts:
+        tool.check(text)
+    print(f"sequential: {time.perf_counter() - start:.2f}s")
+
+    for concurrency in [1, 2, 4, 8, 16]:
+        checker = GrammarChecker(tool, concurrency=concurrency)
+        start = time.perf_counter()
+        for _ in checker.iter_check(enumerate(texts)):
+            pass
+        print(f"concurrency {concurrency}: {time.perf_counter() - start:.2f}s")
+
+    for segment in [None, 'paragraph', 'sentence']:
+        checker = GrammarChecker(tool, concurrency=8, segment=segment)
+        n_checks = server.n_checks
+        start = time.perf_counter()
+        for _ in checker.iter_check(enumerate(texts), names=names.__getitem__):
+            pass
+        print(f"segment {segment}: {server.n_checks - n_checks} requests, {time.perf_counter() - start:.2f}s")
@@ -0,0 +1,56 @@
+"""
+Memory benchmark: bytes retained per student by a `Controller` over a synthetic project.
+
+    python bench_memory.py [--students 2000] [--chunksize 500]
+
+The project (genre, flock phrases, program info and eval.csv) is generated in a temporary directory, and the
+memory held after constructing the controller is measured with `tracemalloc` for a small and a large cohort;
+the difference divided by the number of extra students is reported as bytes per student. With `--chunksize`,
+the peak memory of one streaming pass over all the texts is measured instead.
+"""
+import argparse
+import os
+import tempfile
+import tracemalloc
+import numpy as np
+from fetcher import FlockFetcher, ProjectInfoFetcher, StudentFetcher, GenreFormer
+from controller import Controller
+from fixtures import make_project
+
+
+def retained_bytes(n_students, chunksize=None):
+    with tempfile.TemporaryDirectory() as root:
+        make_project(root, n_students)
+        flock_fetcher = FlockFetcher(os.path.join(root, "flock"))
+        student_fetcher = StudentFetcher(root_dir=root, name_list_path="eval.csv", flock_fetcher=flock_fetcher,
+                                         chunksize=chunksize)
+        program_fetcher = ProjectInfoFetcher(os.path.join(root, "program_info"))
+        former = GenreFormer(os.path.join(root, "genre"))
+
+        np.random.seed(0)
+        tracemalloc.start()
+        controller = Controller(genre_former=former, student_fetcher=student_fetcher,
+                                program_fetcher=program_fetcher, streaming=chunksize is not None)
+        if chunksize is not None:
+            for _ in controller.iter_texts():
+                pass
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del controller
+    return current, peak
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--students', default=2000, type=int)
+    arg_parser.add_argument('--chunksize', default=None, type=int)
+    args = arg_parser.parse_args()
+
+    small = max(args.students // 10, 1)
+    small_current, small_peak = retained_bytes(small, chunksize=args.chunksize)
+    current, peak = retained_bytes(args.students, chunksize=args.chunksize)
+    print(f"students: {args.students}, retained: {current / 2 ** 20:.1f} MiB, peak: {peak / 2 ** 20:.1f} MiB")
+    if args.chunksize is None:
+        print(f"bytes per student: {(current - small_current) / (args.students - small):.0f}")
+    else:
+        print(f"peak bytes per student: {(peak - small_peak) / (args.students - small):.0f}")
@@ -1,10 +1,13 @@
 import string
 import warnings
+import weakref
 from copy import deepcopy
 from global_utils import capitalize
 
 
 class Blob:
+    __slots__ = ("entries", "atomic", "entry_separator", "_program", "_index", "_parents", "__weakref__")
+
     def __init__(self, entries, atomic=False, separator=" "):
         if not isinstance(entries, (list, str)):
             raise ValueError(f"Argument entries must be either str or list, got {type(entries)}")
@@ -22,44 +25,124 @@ class Blob:
         self.entries = entries
         self.atomic = atomic
         self.entry_separator = separator
+        self._program = None
+        self._index = None
+        # weak reference(s) to the node(s) this one is an entry of, whose caches an append to it makes stale
+        self._parents = None
+        if not atomic:
+            for entry in entries:
+                entry._add_parent(self)
 
     def fill_(self, d: dict):
         if self.atomic:
             return
 
-        for entry in self.entries:
-            if isinstance(entry, Blob):
-                entry.fill_(d)
+        index = self.blank_index
+        for tag in [tag for tag in d if tag in index]:
+            for blank in index[tag]:
+                blank.append_entry(d[tag].eval())
 
-    def fill(self, d: dict):
-        new = deepcopy(self)
-        new.fill_(d)
-        return new
+        for blanks in index.values():
+            for blank in blanks:
+                for entry in blank.entries:
+                    if isinstance(entry, Blob):
+                        entry.fill_(d)
+
+    def fill(self, d: dict) -> "BoundBlob":
+        """Bind the values in `d` without modifying (or copying) this tree; see `fill_` for in-place filling."""
+        return BoundBlob(self).fill(d)
 
     def serialize(self, ignore_unfilled=False) -> str:
         if not ignore_unfilled:
-            if not self.is_filled:
-                raise ValueError(f"{self} has not been fully filled, "
-                                 f"check the following: \n{self.serialize(ignore_unfilled=True)}")
+            _check_filled(self)
+        return self.compile().render(ignore_unfilled=True)
 
-        if self.atomic:
-            return self._pre_serialize(str(self.entries))
-        else:
-            entry_strings = [entry.serialize(ignore_unfilled=True) for entry in self.entries]
-            entry_strings = [self._pre_serialize(s) for s in entry_strings]
-            return self.entry_separator.join(entry_strings)
+    def serialize_to(self, stream, ignore_unfilled=False):
+        """Like `serialize`, but write the text to `stream` (anything with a `write` method) as it is rendered."""
+        if not ignore_unfilled:
+            _check_filled(self)
+        self.compile().render_to(stream, ignore_unfilled=True)
+
+    def serialize_pieces(self, ignore_unfilled=False) -> list:
+        """Like `serialize`, but as the (text, from_student) pieces of `Program.render_pieces`"""
+        if not ignore_unfilled:
+            _check_filled(self)
+        return self.compile().render_pieces(ignore_unfilled=True)
 
     def _pre_serialize(self, entry_str: str) -> str:
         return entry_str
 
+    def compile(self) -> "Program":
+        """Compile this tree into a flat `Program`; the result is cached until the tree is structurally modified."""
+        if self._program is None:
+            self._program = Program(self._compile())
+        return self._program
+
+    def _compile(self) -> list:
+        """The parts of this tree, compiled bottom-up with an explicit stack instead of recursion"""
+        if self.atomic:
+            return [self._pre_serialize(str(self.entries))]
+
+        # frames are (node, its enumerated entries, its parts so far, its position among its parent's entries)
+        stack = [(self, enumerate(self.entries), [], 0)]
+        while True:
+            node, entries, parts, position = stack[-1]
+            for i, entry in entries:
+                if entry.atomic or isinstance(entry, Blank):
+                    node._add_entry_parts(parts, i, entry._compile())
+                else:
+                    stack.append((entry, enumerate(entry.entries), [], i))
+                    break
+            else:
+                stack.pop()
+                if not stack:
+                    return parts
+                stack[-1][0]._add_entry_parts(stack[-1][2], position, parts)
+
+    def _add_entry_parts(self, parts: list, i: int, entry_parts: list):
+        """Add the compiled parts of the i-th entry to the `parts` of this node"""
+        if i != 0:
+            parts.append(self.entry_separator)
+        entry_parts = _merge_literals(entry_parts)
+        if type(self)._pre_serialize is Blob._pre_serialize:
+            parts.extend(entry_parts)
+        elif all(isinstance(p, str) for p in entry_parts):
+            parts.append(self._pre_serialize("".join(entry_parts)))
+        else:
+            parts.append(Transform(self._pre_serialize, entry_parts))
+
+    @property
+    def blank_index(self) -> "BlankIndex":
+        """tag -> the `Blank`s of this tree with that tag, not descending into their values"""
+        if self._index is None:
+            return self.index_blanks()
+        return self._index
+
+    def index_blanks(self) -> "BlankIndex":
+        """Build (or rebuild) the cached `blank_index`; the parser does this once per parsed tree."""
+        index = BlankIndex()
+        # depth-first, in document order, with an explicit stack instead of recursion
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, Blank):
+                index.setdefault(node.tag, []).append(node)
+            elif not node.atomic:
+                stack.extend(reversed(node.entries))
+        self._index = index
+        return index
+
+    def _collect_tags(self, tags: set, unfilled: dict):
+        """Add the tags of all blanks in this tree and in their values to `tags`, and the ones
+        without a value to `unfilled` (tag -> whether it is required, i.e. a `Placeholder`)"""
+        index = _summarize(self)
+        tags |= index.tags
+        for tag, required in index.unfilled.items():
+            unfilled[tag] = unfilled.get(tag, False) or required
+
     @property
     def is_filled(self):
-        if self.atomic:
-            return True
-        for entry in self.entries:
-            if not entry.is_filled:
-                return False
-        return True
+        return not any(_summarize(self).unfilled.values())
 
     def append_entry(self, entry):
         if self.atomic:
@@ -69,21 +152,62 @@ class Blob:
             raise ValueError(f"cannot append entry {entry} of type {type(entry)} to {self}")
 
         self.entries.append(entry)
+        entry._add_parent(self)
+        self._invalidate()
 
     def list_unfilled_tags(self):
-        if self.atomic:
-            return []
-
-        if isinstance(self, Blank) and len(self.entries) == 0:
-            return [self.tag]
-
-        tags = []
-        for entry in self.entries:
-            if isinstance(entry, Blank) and len(entry.entries) == 0:
-                tags.append(entry.tag)
-            tags += entry.list_unfilled_tags()
+        return list(_summarize(self).unfilled)
 
-        return tags
+    def _add_parent(self, parent):
+        # atoms are never modified, and are shared too widely to keep track of
+        if self.atomic:
+            return
+        # most nodes have a single parent, referred to directly; shared ones keep a tuple of the live ones
+        if self._parents is None:
+            self._parents = weakref.ref(parent)
+        else:
+            self._parents = tuple(ref for ref in self._iter_parents()) + (weakref.ref(parent),)
+
+    def _iter_parents(self):
+        parents = self._parents
+        for ref in (parents,) if isinstance(parents, weakref.ref) else parents or ():
+            if ref() is not None:
+                yield ref
+
+    def _invalidate(self):
+        """
+        Drop the caches made stale by an entry appended to this node, here and in all nodes containing it. Only the
+        unfilled tags are stale above a `Blank`, whose compiled program and index do not look into its values.
+        """
+        stack = [(self, not isinstance(self, Blank))]
+        seen = set()
+        while stack:
+            node, structural = stack.pop()
+            if (id(node), structural) in seen:
+                continue
+            seen.add((id(node), structural))
+            if structural:
+                node._program = None
+                node._index = None
+            elif node._index is not None:
+                node._index.tags = node._index.unfilled = None
+            for ref in node._iter_parents():
+                parent = ref()
+                if parent is not None:
+                    stack.append((parent, structural and not isinstance(parent, Blank)))
+
+    def __getstate__(self):
+        # weak references cannot be copied or pickled: the restored entries are linked to their restored parents
+        return None, {name: getattr(self, name) for cls in type(self).__mro__ for name in getattr(cls, "__slots__", ())
+                      if name not in ("_parents", "__weakref__")}
+
+    def __setstate__(self, state):
+        for name, value in state[1].items():
+            setattr(self, name, value)
+        self._parents = None
+        if not self.atomic:
+            for entry in self.entries:
+                entry._add_parent(self)
 
     def eval(self):
         return self
@@ -93,6 +217,8 @@ class Blob:
 
 
 class Block(Blob):
+    __slots__ = ()
+
     def cast_to(self, block_type, sep=None, copy=False):
         constructor = get_block_constructor(block_type)
         entries = deepcopy(self.entries) if copy else self.entries
@@ -103,11 +229,15 @@ class Block(Blob):
 
 
 class Article(Block):
+    __slots__ = ()
+
     def __init__(self, entries, atomic=False):
         super(Article, self).__init__(entries, atomic=atomic, separator="\n")
 
 
 class Paragraph(Block):
+    __slots__ = ()
+
     def __init__(self, entries, atomic=False):
         super(Paragraph, self).__init__(entries, atomic=atomic, separator=" ")
 
@@ -119,6 +249,8 @@ class Paragraph(Block):
 
 
 class Sentence(Block):
+    __slots__ = ()
+
     def __init__(self, entries, atomic=False):
         super(Sentence, self).__init__(entries, atomic=atomic, separator=" ")
 
@@ -127,26 +259,46 @@ class Sentence(Block):
 
 
 class Atom(Block):
+    __slots__ = ()
+
     def __init__(self, entries):
         super(Atom, self).__init__(entries, atomic=True, separator=" ")
 
+    # atoms are immutable and may be shared between trees (see `get_atom`), so copies can reuse them
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
     def __repr__(self):
         return f"<{self.__class__.__name__} of {self.entries}>"
 
 
 class Blank(Blob):
+    __slots__ = ("tag",)
+
     def __init__(self, tag, separator="\n--blank-sperator--\n"):
         super(Blank, self).__init__(entries=[], atomic=False, separator=separator)
         self.tag = tag
 
-    def fill_(self, d: dict):
-        for tag in d:
-            if tag == self.tag:
-                self.append_entry(d[tag].eval())
-        super(Blank, self).fill_(d)
+    def _compile(self) -> list:
+        return [Ref(self)]
+
+    def _resolve(self, bindings, ignore_unfilled) -> list:
+        """The parts this blank renders to: its values, joined by the separator."""
+        keeps_entries = type(self)._pre_serialize is Blob._pre_serialize
+        parts = []
+        for value in self.entries + list(bindings.get(self.tag, ())):
+            if parts:
+                parts.append(self.entry_separator)
+            parts.append(value if keeps_entries else Transform(self._pre_serialize, [value]))
+        return parts
 
 
 class Slot(Blank):
+    __slots__ = ()
+
     def append_entry(self, entries):
         if isinstance(entries, (list, tuple)):
             for entry in entries:
@@ -159,16 +311,22 @@ class Slot(Blank):
 
 
 class ParagraphSlot(Slot):
+    __slots__ = ()
+
     def __init__(self, tag):
         super(ParagraphSlot, self).__init__(tag, separator="\n")
 
 
 class SentenceSlot(Slot):
+    __slots__ = ()
+
     def __init__(self, tag):
         super(SentenceSlot, self).__init__(tag, separator=" ")
 
 
 class Placeholder(Blank):
+    __slots__ = ("_filled",)
+
     def __init__(self, tag):
         super(Placeholder, self).__init__(tag=tag, separator=" ")
         self._filled = False
@@ -177,16 +335,20 @@ class Placeholder(Blank):
         super(Placeholder, self).append_entry(entry)
         self._filled = True
 
-    def serialize(self, ignore_unfilled=False):
-        if self.is_filled:
-            return self._pre_serialize(self.entries[0].serialize())
-        if ignore_unfilled:
-            return f"<Unfilled Tag `{self.tag}`>"
-
     @property
     def is_filled(self):
         return self._filled
 
+    def _resolve(self, bindings, ignore_unfilled) -> list:
+        values = self.entries or bindings.get(self.tag, ())
+        if values:
+            if type(self)._pre_serialize is Blob._pre_serialize:
+                return [values[0]]
+            return [Transform(self._pre_serialize, [values[0]])]
+        if ignore_unfilled:
+            return [f"<Unfilled Tag `{self.tag}`>"]
+        raise ValueError(f"{self} has not been filled")
+
     def __repr__(self):
         repr = f"{self.__class__.__name__} with tag={self.tag}"
         if self.is_filled:
@@ -202,66 +364,432 @@ class Placeholder(Blank):
 
 
 class CapitalizedPlaceholder(Placeholder):
+    __slots__ = ()
+
     def _pre_serialize(self, entry_str: str) -> str:
         return " ".join([capitalize(s) for s in entry_str.split()])
 
 
 class LastNamePlaceholder(CapitalizedPlaceholder):
+    __slots__ = ()
+
     def __init__(self):
         super(LastNamePlaceholder, self).__init__("last_name")
 
 
 class FirstNamePlaceholder(CapitalizedPlaceholder):
+    __slots__ = ()
+
     def __init__(self):
         super(FirstNamePlaceholder, self).__init__("first_name")
 
 
 class DatePlaceholder(CapitalizedPlaceholder):
+    __slots__ = ()
+
     def __init__(self):
         super(DatePlaceholder, self).__init__("date")
 
 
 class ProjectNamePlaceholder(Placeholder):
+    __slots__ = ()
+
     def __init__(self):
         super(ProjectNamePlaceholder, self).__init__("project_name")
 
 
 class PronounPlaceholder(Placeholder):
-    pass
+    __slots__ = ()
 
 
 class HePlaceholder(Placeholder):
+    __slots__ = ()
+
     def __init__(self):
         super(HePlaceholder, self).__init__('he')
 
 
 class HisPlaceholder(Placeholder):
+    __slots__ = ()
+
     def __init__(self):
         super(HisPlaceholder, self).__init__('his')
 
 
 class HimPlaceholder(Placeholder):
+    __slots__ = ()
+
     def __init__(self):
         super(HimPlaceholder, self).__init__('him')
 
 
 class HimselfPlaceholder(Placeholder):
+    __slots__ = ()
+
     def __init__(self):
         super(HimselfPlaceholder, self).__init__('himself')
 
 
 class GroupIdPlaceholder(Placeholder):
+    __slots__ = ()
+
     def __init__(self):
         super(GroupIdPlaceholder, self).__init__('gid')
 
 
 class SignaturePlaceholder(Placeholder):
+    __slots__ = ()
+
     def __init__(self):
         super(SignaturePlaceholder, self).__init__('signature')
 
 
 class TaggedPlaceholder(Placeholder):
-    pass
+    __slots__ = ()
+
+
+class BlankIndex(dict):
+    """
+    tag -> `Blank`s of a tree (see `Blob.blank_index`), which also keeps the `tags` of the blanks in the tree and in
+    their values, and the `unfilled` ones among them (tag -> whether it is required); None until `_summarize`d
+    """
+
+    __slots__ = ("tags", "unfilled")
+
+    def __init__(self):
+        super(BlankIndex, self).__init__()
+        self.tags = None
+        self.unfilled = None
+
+
+class Ref:
+    """Reference from a compiled `Program` to a `Blank`, resolved against the bindings at render time."""
+
+    __slots__ = ("blank",)
+
+    def __init__(self, blank):
+        self.blank = blank
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} to tag={self.blank.tag}>"
+
+
+class Transform:
+    """A `_pre_serialize` hook that could not be precomputed because its input contains a `Ref`."""
+
+    __slots__ = ("func", "parts")
+
+    def __init__(self, func, parts):
+        self.func = func
+        self.parts = _merge_literals(parts)
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} {self.func.__qualname__} of {self.parts}>"
+
+
+class Program:
+    """
+    Flat form of a `Blob` tree: static text is serialized once into literal strings, and only the blanks
+    (`Ref`) and the `_pre_serialize` hooks wrapping them (`Transform`) are left to be evaluated per render.
+    """
+
+    __slots__ = ("parts",)
+
+    def __init__(self, parts):
+        self.parts = _merge_literals(parts)
+
+    @property
+    def is_static(self):
+        return all(isinstance(p, str) for p in self.parts)
+
+    def render(self, bindings=None, ignore_unfilled=False) -> str:
+        """
+        Render the program, resolving each blank to its own entries followed by `bindings[tag]`.
+        `bindings` maps a tag to a sequence of `Blob` values, see `collect_bindings`.
+        """
+        out = []
+        _render_parts(self.parts, bindings or {}, ignore_unfilled, out)
+        return "".join(out)
+
+    def render_to(self, stream, bindings=None, ignore_unfilled=False):
+        """Render into `stream`; fragments are written as soon as no `Transform` needs to see them."""
+        _render_parts(self.parts, bindings or {}, ignore_unfilled, [], stream=stream)
+
+    def render_pieces(self, bindings=None, ignore_unfilled=False) -> list:
+        """
+        Render the program into (text, from_student) pieces, whose concatenation is what `render` returns: runs of
+        template text (the program's literals and those of the phrases bound to slots) alternate with the values
+        bound to `Placeholder`s, i.e. student data. A word is never split between two pieces.
+        """
+        out, sources = [], []
+        _render_parts(self.parts, bindings or {}, ignore_unfilled, out, sources=sources)
+        return _merge_pieces(out, sources)
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} with parts {list(self.parts)}>"
+
+
+class BoundBlob:
+    """
+    A template `Blob` plus the values bound to its blanks (tag -> tuple of values, in fill order).
+    The template is shared and never modified, so binding costs O(tags) instead of a deepcopy of the tree.
+    """
+
+    __slots__ = ("template", "bindings", "_tags", "_unfilled")
+
+    def __init__(self, template: Blob):
+        self.template = template
+        self.bindings = {}
+        self._tags = set()
+        self._unfilled = {}
+        template._collect_tags(self._tags, self._unfilled)
+
+    def fill(self, d: dict) -> "BoundBlob":
+        """Bind the values in `d` whose tags occur in the template or in the values bound so far."""
+        new = BoundBlob.__new__(BoundBlob)
+        new.template = self.template
+        new.bindings = dict(self.bindings)
+        new._tags = set(self._tags)
+        new._unfilled = dict(self._unfilled)
+
+        pending = [tag for tag in d if tag in new._tags]
+        while pending:
+            tag = pending.pop()
+            values = collect_bindings({tag: d[tag]})[tag]
+            new.bindings[tag] = new.bindings.get(tag, ()) + values
+            new._unfilled.pop(tag, None)
+            for value in values:
+                tags, unfilled = set(), {}
+                value._collect_tags(tags, unfilled)
+                pending += [t for t in tags - new._tags if t in d]
+                new._tags |= tags
+                for t, required in unfilled.items():
+                    if t not in new.bindings:
+                        new._unfilled[t] = new._unfilled.get(t, False) or required
+        return new
+
+    def _collect_tags(self, tags: set, unfilled: dict):
+        tags |= self._tags
+        for tag, required in self._unfilled.items():
+            unfilled[tag] = unfilled.get(tag, False) or required
+
+    def eval(self):
+        return self
+
+    def serialize(self, ignore_unfilled=False) -> str:
+        if not ignore_unfilled:
+            _check_filled(self)
+        return self.template.compile().render(self.bindings, ignore_unfilled=True)
+
+    def serialize_to(self, stream, ignore_unfilled=False):
+        if not ignore_unfilled:
+            _check_filled(self)
+        self.template.compile().render_to(stream, self.bindings, ignore_unfilled=True)
+
+    def serialize_pieces(self, ignore_unfilled=False) -> list:
+        """Like `serialize`, but as the (text, from_student) pieces of `Program.render_pieces`"""
+        if not ignore_unfilled:
+            _check_filled(self)
+        return self.template.compile().render_pieces(self.bindings, ignore_unfilled=True)
+
+    @property
+    def is_filled(self):
+        return not any(self._unfilled.values())
+
+    def list_unfilled_tags(self):
+        return list(self._unfilled)
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} of {self.template!r} with bound tags {list(self.bindings)}>"
+
+
+def _chain_bindings(first, then):
+    chained = dict(then)
+    for tag, values in first.items():
+        chained[tag] = values + then.get(tag, ())
+    return chained
+
+
+# summaries are only ever read, never updated in place
+_NO_TAGS = frozenset()
+_NO_UNFILLED = {}
+
+
+def _values(index):
+    """The non-atomic values of the blanks of `index` that count towards its tags, in order"""
+    for blanks in index.values():
+        for blank in blanks:
+            for value in blank.entries[:1] if isinstance(blank, Placeholder) else blank.entries:
+                if not value.atomic:
+                    yield value
+
+
+def _summarize(blob) -> BlankIndex:
+    """The `blank_index` of `blob`, with its tags and unfilled tags brought up to date bottom-up, without recursion"""
+    stack = [blob]
+    while stack:
+        index = stack[-1].blank_index
+        if index.unfilled is not None:
+            stack.pop()
+            continue
+        pending = [value for value in _values(index) if value.blank_index.unfilled is None]
+        if pending:
+            stack.extend(pending)
+            continue
+        stack.pop()
+        tags, unfilled = set(index), {}
+        for tag, blanks in index.items():
+            for blank in blanks:
+                if blank.entries:
+                    for value in blank.entries[:1] if isinstance(blank, Placeholder) else blank.entries:
+                        if not value.atomic:
+                            tags |= value.blank_index.tags
+                            for t, required in value.blank_index.unfilled.items():
+                                unfilled[t] = unfilled.get(t, False) or required
+                else:
+                    unfilled[tag] = unfilled.get(tag, False) or isinstance(blank, Placeholder)
+        # most values have no blanks: they share the empty summary
+        index.tags = frozenset(tags) if tags else _NO_TAGS
+        index.unfilled = unfilled or _NO_UNFILLED
+    return blob.blank_index
+
+
+def _check_filled(blob):
+    if not blob.is_filled:
+        raise ValueError(f"{blob.__class__.__name__} has not been fully filled, "
+                         f"check the following tags: {blob.list_unfilled_tags()}")
+
+
+def _merge_literals(parts):
+    merged = []
+    for part in parts:
+        if isinstance(part, str) and merged and isinstance(merged[-1], str):
+            merged[-1] += part
+        else:
+            merged.append(part)
+    return tuple(merged)
+
+
+def _render_parts(parts, bindings, ignore_unfilled, out, stream=None, sources=None):
+    """
+    Render `parts` into the buffer `out` with an explicit stack instead of recursion. Each frame is
+    (parts iterator, bindings, hook, from_student), where hook is the (func, start of its output in `out`) of a
+    `Transform`, and from_student tells whether the frame renders the value of a `Placeholder`.
+    With a `stream`, fragments outside of any `Transform` are written to it directly instead of buffered.
+    With a `sources` list, it gets the from_student flag of every fragment in `out`.
+    """
+    stack = [(iter(parts), bindings, None, False)]
+    n_hooks = 0
+    while stack:
+        parts_iter, bindings, hook, from_student = stack[-1]
+        for part in parts_iter:
+            if isinstance(part, str):
+                if stream is not None and n_hooks == 0:
+                    stream.write(part)
+                else:
+                    out.append(part)
+                    if sources is not None:
+                        sources.append(from_student)
+            elif isinstance(part, Transform):
+                stack.append((iter(part.parts), bindings, (part.func, len(out)), from_student))
+                n_hooks += 1
+                break
+            elif isinstance(part, Ref):
+                stack.append((iter(part.blank._resolve(bindings, ignore_unfilled)), bindings, None,
+                              from_student or isinstance(part.blank, Placeholder)))
+                break
+            elif isinstance(part, BoundBlob):
+                stack.append((iter(part.template.compile().parts), _chain_bindings(part.bindings, bindings), None,
+                              from_student))
+                break
+            else:
+                stack.append((iter(part.compile().parts), bindings, None, from_student))
+                break
+        else:
+            stack.pop()
+            if hook is not None:
+                func, mark = hook
+                n_hooks -= 1
+                s = func("".join(out[mark:]))
+                if stream is not None and n_hooks == 0:
+                    stream.write(s)
+                    del out[mark:]
+                elif sources is not None:
+                    _transform_fragments(s, out, sources, mark)
+                else:
+                    out[mark:] = [s]
+
+
+def _transform_fragments(s, out, sources, mark):
+    """
+    Replace the fragments out[mark:] by `s`, their joint output through a `Transform`. The `_pre_serialize` hooks
+    strip and capitalize, so the fragments are trimmed to what is left of them in `s`; any other change makes `s`
+    a single fragment counted as student data.
+    """
+    fragments = out[mark:]
+    joined = "".join(fragments)
+    if s == joined:
+        return
+    lead = len(joined) - len(joined.lstrip())
+    core = joined.strip()
+    if len(s) != len(core) or s[1:] != core[1:]:
+        out[mark:] = [s]
+        sources[mark:] = [True]
+        return
+    trimmed, trimmed_sources = [], []
+    start = 0
+    for fragment, from_student in zip(fragments, sources[mark:]):
+        lower, upper = max(lead - start, 0), min(len(fragment), lead + len(core) - start)
+        start += len(fragment)
+        if lower < upper:
+            trimmed.append(fragment[lower:upper])
+            trimmed_sources.append(from_student)
+    if trimmed:
+        trimmed[0] = s[0] + trimmed[0][1:]
+    out[mark:] = trimmed
+    sources[mark:] = trimmed_sources
+
+
+def _is_word_char(c):
+    return c.isalnum() or c == "_"
+
+
+def _merge_pieces(fragments, sources):
+    """(text, from_student) pieces of rendered fragments: template runs are merged, and so are pieces a word spans"""
+    pieces = []
+    for fragment, from_student in zip(fragments, sources):
+        if not fragment:
+            continue
+        if pieces:
+            text, was_student = pieces[-1]
+            if not (from_student or was_student) or _is_word_char(text[-1]) and _is_word_char(fragment[0]):
+                pieces[-1] = (text + fragment, from_student or was_student)
+                continue
+        pieces.append((fragment, from_student))
+    return pieces
+
+
+def collect_bindings(*ds):
+    """Merge fill dicts (tag -> data) into bindings (tag -> tuple of `Blob`), earlier dicts first."""
+    bindings = {}
+    for d in ds:
+        for tag, data in d.items():
+            value = data.eval()
+            values = tuple(value) if isinstance(value, (list, tuple)) else (value,)
+            bindings[tag] = bindings.get(tag, ()) + values
+    return bindings
+
+
+# weak, so that words (and per-student values) are forgotten once no tree uses them any more
+_ATOMS = weakref.WeakValueDictionary()
+
+
+def get_atom(s: str) -> Atom:
+    """Return the interned `Atom` of `s`, so that a word repeated across trees is stored once."""
+    atom = _ATOMS.get(s)
+    if atom is None:
+        atom = _ATOMS[s] = Atom(s)
+    return atom
 
 
 def get_blank(tag):
@@ -1,8 +1,119 @@
 import re
+import json
+from collections import defaultdict, namedtuple, Counter
 from abc import abstractmethod
+from itertools import chain
+
+
+TOKEN_RE = re.compile(r"[A-Za-z0-9]+")
+SEPARATOR_RE = re.compile(r"[^A-Za-z0-9 ]")
+MARKS = ("_", "'", "’")
+
+
+def split_words(s):
+    """The alphanumeric tokens of `s`, as a `Document` has them"""
+    return tuple(SEPARATOR_RE.sub(" ", s).split())
+
+
+class Document:
+    """
+    A letter tokenized once for all checkers. Besides the raw `text`, it offers the views checkers declare in their
+    `needs`: the alphanumeric `tokens`, their `lower`-cased forms and the `marks` (underscores, apostrophes) that occur
+    are built up front, the `spans` of the tokens in the text are only located once a checker asks for them.
+    A letter put together by a `PieceCache` also carries the `scans` of its pieces, by checker.
+    """
+    __slots__ = ('text', 'tokens', 'lower', 'marks', '_spans', 'scans')
+    VIEWS = frozenset({'tokens', 'lower', 'spans', 'marks'})
+
+    def __init__(self, text, needs=VIEWS):
+        self.text = text
+        # substituting and splitting beats `TOKEN_RE.findall`
+        words = SEPARATOR_RE.sub(" ", text) if needs & {'tokens', 'lower'} else ""
+        self.tokens = words.split() if 'tokens' in needs else None
+        self.lower = words.lower().split() if 'lower' in needs else None
+        self.marks = frozenset(mark for mark in MARKS if mark in text) if 'marks' in needs else None
+        self._spans = None
+        self.scans = None
+
+    @property
+    def spans(self):
+        if self._spans is None:
+            self._spans = [m.span() for m in TOKEN_RE.finditer(self.text)]
+        return self._spans
+
+    @classmethod
+    def of(cls, s, needs=VIEWS):
+        return s if isinstance(s, cls) else cls(s, needs)
+
+    @staticmethod
+    def needed_by(checkers):
+        """The views a `Document` must offer to the given checkers"""
+        return frozenset().union(*(c.needs for c in checkers if isinstance(c, Checker)))
+
+
+class PieceCache:
+    """
+    Tokenized and scanned pieces of letters, see `BoundBlob.serialize_pieces`. Letters share most of their text, that
+    of the genre and of the flock phrases: each such template piece is post-processed, tokenized and scanned by the
+    checkers that can check pieces apart only once. So are pieces of student data. Of either kind, only the `size`
+    most recently added pieces are remembered. `document` then puts a letter's `Document` together from its pieces.
+    """
+
+    def __init__(self, checkers, post_processor=None, size=4096):
+        checkers = [c for c in checkers if isinstance(c, Checker)]
+        self.scanners = [c for c in checkers if c.scans_pieces]
+        self.needs = Document.needed_by(checkers)
+        self.post_processor = post_processor
+        self.size = size
+        self.template = {}
+        self.student = {}
+
+    def _piece(self, raw, from_student):
+        """(document, [(checker, scan) of the checkers that found something]) of a piece not cached yet"""
+        doc = Document(self.post_processor(raw) if self.post_processor else raw, self.needs)
+        scans = [(checker, checker.scan(doc)) for checker in self.scanners]
+        entry = (doc, [(checker, scan) for checker, scan in scans if scan])
+        cache = self.student if from_student else self.template
+        if len(cache) >= self.size:
+            # first in, first out: common pieces, e.g. pronouns or the genre's, are soon back
+            del cache[next(iter(cache))]
+        cache[raw] = entry
+        return entry
+
+    def document(self, text, pieces):
+        """The `Document` of a letter's (post-processed) `text`, rendered as `pieces`"""
+        template, student = self.template, self.student
+        entries = [(student if from_student else template).get(raw) or self._piece(raw, from_student)
+                   for raw, from_student in pieces]
+        docs = [doc for doc, _ in entries]
+        if "".join([doc.text for doc in docs]) != text:
+            # a post-processor looked across pieces
+            return Document(text, self.needs)
+
+        letter = Document(text, frozenset())
+        if 'tokens' in self.needs:
+            letter.tokens = list(chain.from_iterable([doc.tokens for doc in docs]))
+        if 'lower' in self.needs:
+            letter.lower = list(chain.from_iterable([doc.lower for doc in docs]))
+        if 'marks' in self.needs:
+            letter.marks = frozenset().union(*[doc.marks for doc in docs])
+        letter.scans = {checker: [] for checker in self.scanners}
+        offset = n_tokens = 0
+        for doc, scans in entries:
+            for checker, scan in scans:
+                letter.scans[checker].append((offset, n_tokens, scan))
+            offset += len(doc.text)
+            n_tokens += len(doc.tokens if doc.tokens is not None else doc.lower or ())
+        return letter
 
 
 class Checker:
+    # the `Document` views `check` uses
+    needs = frozenset()
+    # whether a letter can be checked by `scan`ning its pieces apart, then `conclude`-ing on all of their scans
+    scans_pieces = False
+    CONTEXT_RADIUS = 30
+
     def __init__(self, summarizers=None):
         if summarizers is None:
             self.summarizers = []
@@ -12,94 +123,200 @@ class Checker:
     def append_summarizer(self, s):
         self.summarizers.append(s)
 
-    def update_summary(self, which, msg):
+    @classmethod
+    def window(cls, s, span, radius=None):
+        radius = cls.CONTEXT_RADIUS if radius is None else radius
+        l, r = span
+        return s[max(l - radius, 0): min(r + radius, len(s))]
+
+    def update_summary(self, which, code, detail="", span=None, text=None):
+        """
+        Report a finding of kind `code` in the letter `which`, either an index or a name, or an (index, name) pair.
+        With the `span` of the finding in the letter's `text`, a short context around it is kept too.
+        """
+        context = self.window(text, span) if span is not None and text is not None else None
         for s in self.summarizers:
-            s.register(self, which, msg)
+            s.register(self, which, code, detail, span, context)
 
     @abstractmethod
-    def check(self, filename, s: str):
+    def check(self, filename, s):
+        """Check a letter, either its text or a `Document` offering the views in `needs`"""
         pass
 
+    @abstractmethod
+    def scan(self, doc):
+        """What `conclude` needs to know of a piece of a letter, with offsets relative to the piece"""
+        pass
+
+    @abstractmethod
+    def conclude(self, which, doc, scans):
+        """Report the findings in the letter `doc`, given the (offset, token offset, scan) of each of its pieces"""
+        pass
+
+    def check_scans(self, which, s, *args):
+        """`check` by way of `scan` and `conclude`, reusing the scans of the pieces of a `PieceCache` letter"""
+        doc = Document.of(s, self.needs)
+        scans = doc.scans[self] if doc.scans is not None and self in doc.scans else [(0, 0, self.scan(doc))]
+        self.conclude(which, doc, scans, *args)
+
 
-TAG_RE = "__(.*?)__"
+TAG_RE = re.compile("__(.*?)__")
 MALE_PRONOUNS = ['he', 'him', 'his', 'himself']
 FEMALE_PRONOUNS = ['she', 'her', 'her', 'herself']
 
+Finding = namedtuple("Finding", ["checker", "student", "name", "code", "detail", "span", "context"])
+
+MESSAGES = {
+    "unresolved-tag": 'unresolved tag "{detail}"',
+    "underscore": "resolved underscore",
+    "opposite-pronoun": 'pronoun "{detail}" of the opposite gender',
+    "no-pronouns": "no gender pronouns found",
+    "first-name-not-listed": 'target first name "{detail}" not listed',
+    "last-name-not-listed": 'target last name "{detail}" not listed',
+    "alien-first-name": 'alien first name "{detail}" found',
+    "alien-last-name": 'alien last name "{detail}" found',
+    "first-name-missing": 'target first name "{detail}" not found',
+    "last-name-missing": 'target last name "{detail}" not found',
+    "mixed-apostrophes": "both straight and curly apostrophes found",
+    "unpreferred-apostrophe": "apostrophe preference is set to {detail} but the other style is found",
+    "second-person": 'second person pronoun "{detail}" found',
+}
+
 
 class CheckSummarizer:
-    def __init__(self):
-        self.check_class_names = []
-        self.which = []
-        self.messages = []
+    """
+    Collects the findings of checkers as compact `Finding` records.
+
+    Every finding is counted, the first `cap` findings of each checker are written to the JSONL file at `path` as they
+    come, and only the first `keep` are held in memory for a human-readable summary.
+    """
+
+    def __init__(self, path=None, cap=1000, keep=20):
+        self.path = path
+        self.cap = cap
+        self.keep = keep
+        self.counts = Counter()  # by (checker, code)
+        self.checker_counts = Counter()
+        self.findings = []
+        self._file = open(path, "w") if path else None
+
+    def register(self, checker, which, code, detail="", span=None, context=None):
+        if isinstance(which, tuple):
+            student, name = which
+        elif isinstance(which, int):
+            student, name = which, None
+        else:
+            student, name = None, which
+        self.add(Finding(checker.__class__.__name__, student, name, code, str(detail), span, context))
+
+    def add(self, finding):
+        self.counts[finding.checker, finding.code] += 1
+        self.checker_counts[finding.checker] += 1
+        if len(self.findings) < self.keep:
+            self.findings.append(finding)
+        if self._file and self.checker_counts[finding.checker] <= self.cap:
+            self._file.write(json.dumps(finding._asdict(), ensure_ascii=False) + "\n")
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    @property
+    def total(self):
+        return sum(self.checker_counts.values())
 
-    def register(self, checker, which, msg):
-        self.check_class_names.append(checker.__class__.__name__)
-        self.which.append(str(which))
-        self.messages.append(str(msg))
+    @staticmethod
+    def format(finding):
+        which = finding.name if finding.student is None else \
+            f"letter {finding.student}" + (f" ({finding.name})" if finding.name else "")
+        message = MESSAGES.get(finding.code, finding.code).format(detail=finding.detail)
+        context = " ".join(finding.context.split()) if finding.context else None
+        return f"{finding.checker}: in {which}: {message}" + (f": ...{context}..." if context else "")
 
     def get_summaries(self):
-        if len(self.check_class_names) == 0:
+        """Human-readable lines of the findings held in memory, or None if there are none"""
+        if not self.findings:
             return None
+        return [self.format(finding) for finding in self.findings]
 
-        return [f"{c}: in {w}: {m}" for c, w, m in zip(self.check_class_names, self.which, self.messages)]
+    def summary(self):
+        """A human-readable summary: the first findings and the counts of all, or None if there are none"""
+        summaries = self.get_summaries()
+        if summaries is None:
+            return None
+        lines = [f"{self.total} warning(s) found:"] + summaries
+        if self.total > len(summaries):
+            lines.append(f"... and {self.total - len(summaries)} more" + (f", see {self.path}" if self.path else ""))
+        counts = sorted(self.counts.items())
+        lines.append("counts: " + ", ".join(f"{checker} {code}: {n}" for (checker, code), n in counts))
+        return "\n".join(lines)
 
 
 class PlaceholderChecker(Checker):
-    def check(self, filename, s: str):
-        tags = re.findall(TAG_RE, s)
-        if len(tags) != 0:
-            self.update_summary(filename, f"unresolved tags found: {tags}, {s}")
+    needs = frozenset({'marks'})
+    scans_pieces = True
+
+    def check(self, filename, s):
+        self.check_scans(filename, s)
+
+    def scan(self, doc):
+        if "_" not in doc.marks:
+            return ()
+        s = doc.text
+        found = []
+        for match in TAG_RE.finditer(s):
+            found.append(("unresolved-tag", match.group(1), match.span()))
+        tagged = [span for _, _, span in found]
 
         i = s.find("_")
-        underscore_occurences = []
         while i != -1:
-            lower = max(0, i - 5)
-            upper = min(i + 5 + 1, len(s))
-            underscore_occurences.append(s[lower:upper])
+            if not any(l <= i < r for l, r in tagged):
+                found.append(("underscore", "", (i, i + 1)))
             i = s.find("_", i + 1)
+        return found
 
-        if len(underscore_occurences) != 0:
-            self.update_summary(filename, "resolved underscores: \n" + "\n".join(underscore_occurences))
+    def conclude(self, which, doc, scans):
+        for offset, _, found in scans:
+            for code, detail, (l, r) in found:
+                self.update_summary(which, code, detail, (offset + l, offset + r), doc.text)
 
 
 class GenderChecker(Checker):
+    needs = frozenset({'lower'})
+    scans_pieces = True
+    PRONOUNS = frozenset(MALE_PRONOUNS + FEMALE_PRONOUNS)
+
+    def __init__(self, summarizers=None, verbose=True):
+        super(GenderChecker, self).__init__(summarizers=summarizers)
+        # whether to print the gender inferred from consistent pronouns
+        self.verbose = verbose
+
     def check(self, filename, s):
-        s = re.sub('[^A-Za-z0-9 ]', ' ', s)
-        s = s.lower().split()
-        male_indices = [i for i, w in enumerate(s) if w in MALE_PRONOUNS]
-        female_indices = [i for i, w in enumerate(s) if w in FEMALE_PRONOUNS]
+        self.check_scans(filename, s)
 
-        def window(i, half_size=3):
-            lower = max(0, i - half_size)
-            upper = min(i + half_size + 1, len(s))
-            return " ".join(s[lower: upper])
+    def scan(self, doc):
+        """The (index, pronoun) of the pronouns among the tokens"""
+        if self.PRONOUNS.isdisjoint(doc.lower):
+            return ()
+        return [(i, w) for i, w in enumerate(doc.lower) if w in self.PRONOUNS]
 
-        def windows(indices, half_size=3):
-            return "\n".join(window(i, half_size=half_size) for i in indices)
+    def conclude(self, filename, doc, scans):
+        pronouns = [(n_tokens + i, w) for _, n_tokens, found in scans for i, w in found]
+        male_indices = [i for i, w in pronouns if w in MALE_PRONOUNS]
+        female_indices = [i for i, w in pronouns if w in FEMALE_PRONOUNS]
+        words = dict(pronouns)
 
         if len(male_indices) != 0 and len(female_indices) != 0:
             if len(male_indices) > len(female_indices):
-                inferred_gender = "MALE"
                 check_indices = female_indices
-                confidence = len(male_indices) / (len(male_indices) + len(female_indices))
             else:
-                inferred_gender = "FEMALE"
                 check_indices = male_indices
-                confidence = len(female_indices) / (len(male_indices) + len(female_indices))
-
-            self.update_summary(
-                filename,
-                f""" Both MALE and FEMALE pronouns found:
-                Male pronoun count: {len(male_indices)}
-                Female pronoun count: {len(female_indices)}
-                Inferred gender is "{inferred_gender}" with confidence {confidence}
-
-                Check these occurrences of the opposite gender:
-                {windows(check_indices)}"""
-            )
+            for i in check_indices:
+                self.update_summary(filename, "opposite-pronoun", words[i], doc.spans[i], doc.text)
         elif len(male_indices) == 0 and len(female_indices) == 0:
-            self.update_summary(filename, "No gender pronouns found")
-        else:
+            self.update_summary(filename, "no-pronouns")
+        elif self.verbose:
             if len(male_indices) > 0:
                 print("Inferred Gender: M")
             else:
@@ -107,36 +324,97 @@ class GenderChecker(Checker):
 
 
 class NameChecker(Checker):
+    """
+    Reports names of other students in a letter. The roster names, multi-word ones included, are indexed by their
+    first token once, so that every letter is checked in a single pass over its tokens, or rather over the tokens
+    its pieces may have names start at.
+    """
+    needs = frozenset({'tokens'})
+    scans_pieces = True
+
     def __init__(self, first_names, last_names, summarizers=None):
         super(NameChecker, self).__init__(summarizers=summarizers)
         self.first_names = set(first_names)
         self.last_names = set(last_names)
+        # {first token: [(tokens, name, 'first' or 'last'), ...]}
+        self.index = defaultdict(list)
+        for kind, names in [("first", self.first_names), ("last", self.last_names)]:
+            for name in sorted(names):
+                words = split_words(name)
+                if words:
+                    self.index[words[0]].append((words, name, kind))
+
+    @staticmethod
+    def _occurs(tokens, i, words):
+        """Whether `words` occur in `tokens` from i, whose token is known to be words[0]"""
+        return len(words) == 1 or tuple(tokens[i:i + len(words)]) == words
+
+    def find_names(self, tokens, targets, starts=None):
+        """
+        The roster names in `tokens` as (name, 'first' or 'last', index of the first token) triples, in order of
+        appearance and leaving out those within an occurrence of one of the `targets`; and the set of `targets` that
+        occur. `starts` are the indices of the tokens in the index, if known (see `scan`).
+        """
+        heads = defaultdict(list)
+        for name in targets:
+            words = split_words(name)
+            if words:
+                heads[words[0]].append((words, name))
+        found, targets_found = {}, set()
+        end = 0  # the tokens before `end` belong to a target
+        if starts is None:
+            starts = self.scan_tokens(tokens)
+        # the targets are normally on the roster, and so among the starts
+        unlisted = {token for token in heads if token not in self.index}
+        if unlisted:
+            starts = sorted(set(starts).union(i for i, token in enumerate(tokens) if token in unlisted))
+        for i in starts:
+            token = tokens[i]
+            for words, name in heads.get(token, ()):
+                if self._occurs(tokens, i, words):
+                    targets_found.add(name)
+                    end = max(end, i + len(words))
+            if i < end or token not in self.index:
+                continue
+            for words, name, kind in self.index[token]:
+                if self._occurs(tokens, i, words):
+                    found.setdefault((name, kind), i)
+        return [(name, kind, i) for (name, kind), i in found.items()], targets_found
+
+    def scan_tokens(self, tokens):
+        index = self.index
+        return [i for i, token in enumerate(tokens) if token in index]
+
+    def scan(self, doc):
+        """Indices of the tokens that a roster name may start at"""
+        return self.scan_tokens(doc.tokens)
 
     def check(self, filename, s, target_first_name, target_last_name):
-        s = re.sub('[^A-Za-z0-9 ]', ' ', s)
-        s = s.split()
-        old_s = " ".join(s)
+        self.check_scans(filename, s, target_first_name, target_last_name)
+
+    def conclude(self, filename, doc, scans, target_first_name, target_last_name):
         if target_first_name not in self.first_names:
-            self.update_summary(filename, f"Target first name not listed in {self.first_names}: \n {old_s}")
+            self.update_summary(filename, "first-name-not-listed", target_first_name)
         if target_last_name not in self.last_names:
-            self.update_summary(filename, f"Target last name not listed in {self.last_names}: \n {old_s}")
+            self.update_summary(filename, "last-name-not-listed", target_last_name)
 
-        first_names = self.first_names - {target_first_name, target_last_name}
-        last_names = self.last_names - {target_first_name, target_last_name}
+        targets = {target_first_name, target_last_name}
+        starts = [n_tokens + i for _, n_tokens, indices in scans for i in indices]
+        found, targets_found = self.find_names(doc.tokens, targets, starts)
+        for name, kind, i in found:
+            if name not in targets:
+                span = doc.spans[i][0], doc.spans[i + len(split_words(name)) - 1][1]
+                self.update_summary(filename, f"alien-{kind}-name", name, span, doc.text)
 
-        for fn, ln in zip(first_names, last_names):
-            if fn in s:
-                self.update_summary(filename, f'Alien first name "{fn}" found: \n {old_s}')
-            if ln in s:
-                self.update_summary(filename, f'Alien last name "{ln}" found: \n {old_s}')
-
-        if not (target_first_name in s):
-            self.update_summary(filename, f"Target first name not found: \n {old_s}")
-        if not (target_last_name in s):
-            self.update_summary(filename, f"Target last name not found: \n {old_s}")
+        if target_first_name not in targets_found:
+            self.update_summary(filename, "first-name-missing", target_first_name)
+        if target_last_name not in targets_found:
+            self.update_summary(filename, "last-name-missing", target_last_name)
 
 
 class ApostropheChecker(Checker):
+    needs = frozenset({'marks'})
+    scans_pieces = True
     STRAIGHT = "'"
     CURLY = "’"
 
@@ -148,30 +426,53 @@ class ApostropheChecker(Checker):
 
     @property
     def other_style(self):
-        if not preference:
+        if not self.preference:
             raise ValueError("No preference is set")
         return self.STRAIGHT if self.preference == 'curly' else self.CURLY
 
     def check(self, filename, s):
+        self.check_scans(filename, s)
+
+    def scan(self, doc):
+        """{apostrophe: index of its first occurrence}"""
+        return {mark: doc.text.find(mark) for mark in (self.STRAIGHT, self.CURLY) if mark in doc.marks}
+
+    def conclude(self, filename, doc, scans):
+        first = {}
+        for offset, _, found in scans:
+            for mark, i in found.items():
+                first.setdefault(mark, offset + i)
         if not self.preference:
-            if self.STRAIGHT in s and self.CURLY in s:
-                self.update_summary(filename, "Both straight and curly apostrophes are found")
-        elif self.other_style in s:
-            self.update_summary(
-                filename,
-                f"Apostrophe preference is set to {self.preference} but {self.other_style} is found"
-            )
+            if self.STRAIGHT in first and self.CURLY in first:
+                self.update_summary(filename, "mixed-apostrophes")
+        elif self.other_style in first:
+            i = first[self.other_style]
+            self.update_summary(filename, "unpreferred-apostrophe", self.preference, (i, i + 1), doc.text)
 
 
 class SecondPersonChecker(Checker):
+    needs = frozenset({'lower', 'spans'})
+    scans_pieces = True
+    PRONOUNS = frozenset({'you', 'your'})
+
     @staticmethod
-    def window(s, span, radius=30):
+    def is_word(s, span):
+        """Whether the token at `span` is a whole word, not part of one joined by underscores or non-ASCII letters"""
         l, r = span
-        l = max(l - radius, 0)
-        r = min(r + radius, len(s))
-        return s[l: r]
+        return not (l > 0 and (s[l - 1].isalnum() or s[l - 1] == "_") or
+                    r < len(s) and (s[r].isalnum() or s[r] == "_"))
 
     def check(self, filename, s):
-        for match in re.finditer(r"\byou\b|\byour\b", s.lower()):
-            self.update_summary(filename, f"Second person pronouns found\n: {self.window(s, match.span())}")
+        self.check_scans(filename, s)
+
+    def scan(self, doc):
+        if self.PRONOUNS.isdisjoint(doc.lower):
+            return ()
+        return [(token, span) for token, span in zip(doc.lower, doc.spans)
+                if token in self.PRONOUNS and self.is_word(doc.text, span)]
+
+    def conclude(self, filename, doc, scans):
+        for offset, _, found in scans:
+            for token, (l, r) in found:
+                self.update_summary(filename, "second-person", token, (offset + l, offset + r), doc.text)
 
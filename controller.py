@@ -1,112 +1,357 @@
 import os
 import sys
-from fetcher import StudentFetcher, ProjectInfoFetcher, GenreFormer, Fetcher, FlockFetcher
-from io_utils import safe_mkdir, DocxInsertionWriter, TxtWriter, stdio_yn
+import math
+import tempfile
+import multiprocessing
+from collections import Counter
+from fetcher import StudentFetcher, ProjectInfoFetcher, GenreFormer, Fetcher, FlockFetcher, student_rng
+from io_utils import safe_mkdir, DocxInsertionWriter, TxtWriter, ArchiveWriter, stdio_yn
 from typing import Sequence
 from checker import NameChecker, GenderChecker, PlaceholderChecker, CheckSummarizer, ApostropheChecker, \
-    SecondPersonChecker
+    SecondPersonChecker, Document, PieceCache
 from post_process import PostProcessor, compose, ApostrophePostProcessor, EnglishDialectPostProcessor
+from grammar import GrammarChecker, GrammarCache
 import argparse
 import language_tool_python as langtool
 from pathlib import Path
 
 
+WORKER_BATCH = 32
+_worker = {}
+
+
+def _init_worker(genre, post_processors, output_writer, render_only=False):
+    _worker.update(genre=genre, post_processor=compose(*post_processors), output_writer=output_writer,
+                   render_only=render_only)
+
+
+def _write_letter(job):
+    """(text, file data): the data is returned for the parent to save if `render_only`, else written here"""
+    student, program, fname = job
+    content = _worker['post_processor'](_worker['genre'].fill(program).fill(student).serialize())
+    if _worker['render_only']:
+        return content, _worker['output_writer'].render(content)
+    _worker['output_writer'].write(content=content, fname=fname)
+    return content, None
+
+
+def _init_checker(first_names, last_names):
+    # the roster name index is built once per worker; progress is reported by the parent
+    _worker['checkers'] = Controller.make_checkers(first_names, last_names, CheckSummarizer(keep=math.inf),
+                                                   verbose=False)
+
+
+def _check_letter(job):
+    which, content, first_name, last_name = job
+    checkers = _worker['checkers']
+    Controller.run_checkers(checkers, which, content, first_name, last_name)
+    summarizer = checkers['summarizer']
+    findings, summarizer.findings = summarizer.findings, []
+    return findings
+
+
+def _batched(iterable, n):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == n:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
 class Controller:
     def __init__(
             self,
             genre_former: GenreFormer,
             student_fetcher: Fetcher,
             program_fetcher: Fetcher,
-            post_processors: Sequence[PostProcessor] = None
+            post_processors: Sequence[PostProcessor] = None,
+            streaming=False,
+            seed=None,
     ):
+        """
+        With `streaming`, nothing is filled up front: students are fetched, filled, serialized and post-processed
+        one at a time as the texts are iterated, so a single pass over `iter_texts` (e.g. `write_to_disk` with
+        `check_output`) holds only the current letter. Every new pass fetches the students and draws phrases anew.
+
+        With a `seed`, every student draws from its own random stream (see `fetcher.student_rng`), so a letter
+        depends only on the seed, the student's position and the mutex draws before it; otherwise the global numpy
+        state is used.
+        """
         self.genre_former = genre_former
         self.student_fetcher = student_fetcher
         self.program_fetcher = program_fetcher
+        self.streaming = streaming
+        self.seed = seed
 
         self.genre = genre_former.get_genre()
         self.genre.entry_separator = "\n\n"
-        self.student_data = student_fetcher.fetch()
+        self.template = self.genre.compile()
+        self.drafts = None
+        students = student_fetcher.fetch() if not streaming and seed is None else None
         self.program_data = program_fetcher.fetch(verbatim=True)
+        if students is not None:
+            self.drafts = [(student, program_fetcher.fetch()) for student in students]
+        elif not streaming:
+            self.drafts = list(self.iter_drafts())
 
-        self.articles = [self.genre.fill(program_fetcher.fetch()).fill(student) for student in self.student_data]
-        self.post_processor = compose(*(post_processors or []))
+        self.articles = None if streaming else [self.fill(student, program) for student, program in self.drafts]
+        self.post_processors = list(post_processors or [])
+        self.post_processor = compose(*self.post_processors)
         self._texts = None
 
+    def fill(self, student, program):
+        return self.genre.fill(program).fill(student)
+
+    def iter_drafts(self):
+        """Yield the (student, program info) fill dicts of every student, in order"""
+        if self.drafts is not None:
+            yield from self.drafts
+            return
+        index = 0
+        for rows in self.student_fetcher.iter_row_batches():
+            for row in rows:
+                rng = student_rng(self.seed, index)
+                yield self.student_fetcher.fetch_row(row, rng=rng), self.program_fetcher.fetch(rng=rng)
+                index += 1
+
+    def iter_articles(self):
+        """Yield (student, article) pairs"""
+        if self.articles is not None:
+            return zip((student for student, _ in self.drafts), self.articles)
+        return ((student, self.fill(student, program)) for student, program in self.iter_drafts())
+
+    def iter_texts(self):
+        """Yield (student, text) pairs, serializing and post-processing one letter at a time"""
+        if self._texts is not None:
+            return zip((student for student, _ in self.drafts), self._texts)
+        return ((student, self.post_processor(article.serialize())) for student, article in self.iter_articles())
+
+    def iter_pieces(self):
+        """
+        Yield (student, text, pieces) triples: like `iter_texts`, along with the (text, from_student) pieces each
+        letter was rendered from, before post-processing (see `BoundBlob.serialize_pieces`)
+        """
+        for student, article in self.iter_articles():
+            pieces = article.serialize_pieces()
+            yield student, self.post_processor("".join(text for text, _ in pieces)), pieces
+
     def get_articles(self):
+        if self.articles is None:
+            return [article for _, article in self.iter_articles()]
         return self.articles
 
     def get_texts(self, force_rerun=False):
+        if self.streaming:
+            return [text for _, text in self.iter_texts()]
         if force_rerun or self._texts is None:
             self._texts = [self.post_processor(article.serialize()) for article in self.get_articles()]
         return self._texts
 
-    def write_to_disk(self, output_writer, output_dir, language_tool=None, grammar_writer=None, match_policy='all'):
+    @staticmethod
+    def get_names(row):
+        return row['first_name'].eval().serialize(), row['last_name'].eval().serialize()
+
+    @classmethod
+    def get_fname(cls, row, taken):
+        """File name of a student's letter; repeated names are numbered so that no letter overwrites another"""
+        first_name, last_name = cls.get_names(row)
+        fname = f"{first_name}-{last_name}-path-letter"
+        taken[fname] += 1
+        return fname if taken[fname] == 1 else f"{fname}-{taken[fname]}"
+
+    def iter_written(self, output_writer, letter_dir, workers=1, pieces=False):
+        """
+        Write every letter to `letter_dir`, yielding (student, fname, text, pieces) in student order; pieces are those
+        of `iter_pieces` if asked for and written by this process, else None. With several `workers`, filling,
+        serializing, post-processing and writing are spread over a process pool, while the phrases are still drawn
+        here, student by student, so that the output and the mutex balancing do not depend on `workers`. An
+        `ArchiveWriter` only has its files rendered by the pool, and saves them here.
+        """
+        taken = Counter()
+        if workers <= 1:
+            texts = self.iter_pieces() if pieces else ((row, content, None) for row, content in self.iter_texts())
+            for row, content, letter_pieces in texts:
+                fname = self.get_fname(row, taken)
+                output_writer.write(content=content, fname=letter_dir / fname)
+                yield row, fname, content, letter_pieces
+            return
+
+        archived = isinstance(output_writer, ArchiveWriter)
+        with multiprocessing.Pool(workers, initializer=_init_worker,
+                                  initargs=(self.genre, self.post_processors,
+                                            output_writer.writer if archived else output_writer, archived)) as pool:
+            for batch in _batched(self.iter_drafts(), workers * WORKER_BATCH):
+                fnames = [self.get_fname(student, taken) for student, _ in batch]
+                jobs = [(student, program, letter_dir / fname) for (student, program), fname in zip(batch, fnames)]
+                contents = pool.imap(_write_letter, jobs, chunksize=max(1, WORKER_BATCH // 8))
+                for (student, _), fname, (content, data) in zip(batch, fnames, contents):
+                    if data is not None:
+                        output_writer.save(data, letter_dir / fname)
+                    yield student, fname, content, None
+
+    def write_to_disk(self, output_writer, output_dir, language_tool=None, grammar_writer=None, match_policy='all',
+                      check_output=None, workers=1, progress=None):
+        """
+        Write every letter, calling `progress(n)`, if given, once n letters are through; if `check_output` is given,
+        the letters are also checked in the same pass, their findings streamed to findings.jsonl in `output_dir` and
+        reported as in `check_texts(output=check_output)` once all of them are written.
+
+        `language_tool` is a `LanguageTool` or a `GrammarChecker`; either way the letters are sent to its server
+        concurrently, as they are written. A segmenting `GrammarChecker` gets the students' own names masked, so that
+        it can share segments between letters.
+
+        With an `ArchiveWriter`, nothing is written to `output_dir`, which only names the files in the archive; the
+        findings are spooled to a temporary file and added to the archive once all letters are through.
+        """
         output_dir = Path(output_dir)
-        safe_mkdir(output_dir)
-
-        for content, row in zip(self.get_texts(), self.student_data):
-            first_name = row['first_name'].eval().serialize()
-            last_name = row['last_name'].eval().serialize()
-            proposed_fname = f"{first_name}-{last_name}-path-letter"
-            output_writer.write(content=content, fname=output_dir / 'original-letters' / proposed_fname)
-            if language_tool and grammar_writer:
-                matches = language_tool.check(content)
-                if match_policy == 'ask':
-                    applied_matches = []
-                    unapplied_matches = []
-                    for m in matches:
-                        if stdio_yn(str(m) + '\nAccept the above suggestion?'):
-                            applied_matches.append(m)
-                        else:
-                            unapplied_matches.append(m)
-                elif match_policy == 'all':
-                    applied_matches = matches
-                    unapplied_matches = []
-                elif match_policy == 'none':
-                    applied_matches = []
-                    unapplied_matches = matches
+        archive = output_writer.archive if isinstance(output_writer, ArchiveWriter) else None
+        findings_path = output_dir / 'findings.jsonl'
+        if archive is None:
+            safe_mkdir(output_dir)
+        elif check_output:
+            fd, findings_path = tempfile.mkstemp(suffix=".jsonl")
+            os.close(fd)
+        checkers = self.get_checkers(findings_path=findings_path) if check_output else None
+
+        written = (((row, fname, pieces), content) for row, fname, content, pieces in
+                   self.iter_written(output_writer, output_dir / 'original-letters', workers=workers,
+                                     pieces=checkers is not None))
+        if language_tool and grammar_writer:
+            checker = GrammarChecker.wrap(language_tool)
+            names = (lambda item: self.get_names(item[0])) if checker.segment else None
+            checked = checker.iter_check(written, names=names)
+        else:
+            checked = ((item, content, None) for item, content in written)
+
+        try:
+            for index, ((row, fname, pieces), content, matches) in enumerate(checked):
+                if checkers:
+                    self.check_text(checkers, content, row, index, pieces=pieces)
+                if matches is not None:
+                    self.correct_text(content, fname, matches, output_writer, output_dir, grammar_writer,
+                                      match_policy=match_policy)
+                if progress:
+                    progress(index + 1)
+            if checkers and archive is not None:
+                checkers['summarizer'].close()
+                archive.move(findings_path, output_dir / 'findings.jsonl')
+                checkers['summarizer'].path = archive.arcname(output_dir / 'findings.jsonl')
+        finally:
+            if checkers:
+                # also when the letters are not all through, so that no findings are left open or spooled
+                checkers['summarizer'].close()
+                if archive is not None and os.path.exists(findings_path):
+                    os.remove(findings_path)
+
+        if checkers:
+            self.report(checkers, output=check_output)
+
+    @staticmethod
+    def correct_text(content, fname, matches, output_writer, output_dir, grammar_writer, match_policy='all'):
+        if match_policy == 'ask':
+            applied_matches = []
+            unapplied_matches = []
+            for m in matches:
+                if stdio_yn(str(m) + '\nAccept the above suggestion?'):
+                    applied_matches.append(m)
                 else:
-                    raise RuntimeError(f"Unknown matches policy: {match_policy}")
-
-                if applied_matches:
-                    correction = langtool.utils.correct(content, applied_matches)
-                    output_writer.write(content=correction, fname=output_dir / 'corrected-letters' / proposed_fname)
-                    grammar_writer.write(
-                        content='\n\n'.join(str(m) for m in applied_matches),
-                        fname=output_dir / 'applied' / proposed_fname,
-                    )
-                if unapplied_matches:
-                    grammar_writer.write(
-                        content='\n\n'.join(str(m) for m in unapplied_matches),
-                        fname=output_dir / 'unapplied' / proposed_fname,
-                    )
-
-    def check_texts(self, output="stderr"):
-        all_first_names = [row["first_name"].eval().serialize() for row in self.student_data]
-        all_last_names = [row["last_name"].eval().serialize() for row in self.student_data]
-
-        summarizer = CheckSummarizer()
-
-        placeholder_checker = PlaceholderChecker(summarizers=[summarizer])
-        gender_checker = GenderChecker(summarizers=[summarizer])
-        name_checker = NameChecker(all_first_names, all_last_names, summarizers=[summarizer])
-        apostrophe_checker = ApostropheChecker(summarizers=[summarizer])
-        # second_person_checker = SecondPersonChecker(summarizers=[summarizer])
-
-        for content, row in zip(self.get_texts(), self.student_data):
-            first_name = row['first_name'].eval().serialize()
-            last_name = row['last_name'].eval().serialize()
-            filename = f"{first_name} {last_name}"
-            print(f"Checking {filename}", end="\t")
-            placeholder_checker.check(filename, content)
-            gender_checker.check(filename, content)
-            name_checker.check(filename, content, target_first_name=first_name, target_last_name=last_name)
-            apostrophe_checker.check(filename, content)
-            # second_person_checker.check(filename, content)
-
-        summaries = summarizer.get_summaries()
+                    unapplied_matches.append(m)
+        elif match_policy == 'all':
+            applied_matches = matches
+            unapplied_matches = []
+        elif match_policy == 'none':
+            applied_matches = []
+            unapplied_matches = matches
+        else:
+            raise RuntimeError(f"Unknown matches policy: {match_policy}")
+
+        if applied_matches:
+            correction = langtool.utils.correct(content, applied_matches)
+            output_writer.write(content=correction, fname=output_dir / 'corrected-letters' / fname)
+            grammar_writer.write(
+                content='\n\n'.join(str(m) for m in applied_matches),
+                fname=output_dir / 'applied' / fname,
+            )
+        if unapplied_matches:
+            grammar_writer.write(
+                content='\n\n'.join(str(m) for m in unapplied_matches),
+                fname=output_dir / 'unapplied' / fname,
+            )
+
+    def get_checkers(self, findings_path=None):
+        all_first_names, all_last_names = self.student_fetcher.collect_names()
+        return self.make_checkers(all_first_names, all_last_names, CheckSummarizer(path=findings_path),
+                                  post_processor=self.post_processor)
+
+    @staticmethod
+    def make_checkers(all_first_names, all_last_names, summarizer, post_processor=None, verbose=True):
+        checkers = {
+            'summarizer': summarizer,
+            'placeholder': PlaceholderChecker(summarizers=[summarizer]),
+            'gender': GenderChecker(summarizers=[summarizer], verbose=verbose),
+            'name': NameChecker(all_first_names, all_last_names, summarizers=[summarizer]),
+            'apostrophe': ApostropheChecker(summarizers=[summarizer]),
+            # 'second_person': SecondPersonChecker(summarizers=[summarizer]),
+        }
+        checkers['pieces'] = PieceCache(checkers.values(), post_processor=post_processor)
+        return checkers
+
+    @staticmethod
+    def run_checkers(checkers, which, content, first_name, last_name, pieces=None):
+        # tokenized once, into just the views the checkers need; with the pieces the letter was rendered from, only
+        # the ones not seen in earlier letters are
+        if pieces is not None:
+            doc = checkers['pieces'].document(content, pieces)
+        else:
+            doc = Document(content, Document.needed_by(checkers.values()))
+        checkers['placeholder'].check(which, doc)
+        checkers['gender'].check(which, doc)
+        checkers['name'].check(which, doc, target_first_name=first_name, target_last_name=last_name)
+        checkers['apostrophe'].check(which, doc)
+        # checkers['second_person'].check(which, doc)
+
+    def check_text(self, checkers, content, row, index=None, pieces=None):
+        first_name, last_name = self.get_names(row)
+        filename = (index, f"{first_name} {last_name}")
+        print(f"Checking {filename[1]}", end="\t")
+        self.run_checkers(checkers, filename, content, first_name, last_name, pieces=pieces)
+
+    def _check_jobs(self, texts):
+        for index, (row, content, *_) in enumerate(texts):
+            first_name, last_name = self.get_names(row)
+            yield (index, f"{first_name} {last_name}"), content, first_name, last_name
+
+    def check_all(self, checkers, texts, workers=1):
+        """
+        Check (student, text) pairs, or (student, text, pieces) triples of `iter_pieces`. With several `workers`, the
+        letters are checked on a process pool, each worker indexing the roster once, and the findings are merged in
+        letter order, just as one process would find them.
+        """
+        if workers <= 1:
+            for index, (row, content, *pieces) in enumerate(texts):
+                self.check_text(checkers, content, row, index, pieces=pieces[0] if pieces else None)
+            return
+
+        summarizer = checkers['summarizer']
+        initargs = (checkers['name'].first_names, checkers['name'].last_names)
+        with multiprocessing.Pool(workers, initializer=_init_checker, initargs=initargs) as pool:
+            n_checked = 0
+            for batch in _batched(self._check_jobs(texts), workers * WORKER_BATCH * 8):
+                for findings in pool.imap(_check_letter, batch, chunksize=WORKER_BATCH):
+                    for finding in findings:
+                        summarizer.add(finding)
+                n_checked += len(batch)
+                print(f"Checked {n_checked} letters")
+
+    @staticmethod
+    def report(checkers, output="stderr"):
+        """Report a summary of the first findings and the counts of all; the full findings go to their JSONL file"""
+        checkers['summarizer'].close()
+        summaries = checkers['summarizer'].summary()
         if summaries is not None:
-            summaries = f"{len(summaries)} warning(s) found:\n" + "\n".join(summaries)
             if output == "raise":
                 raise ValueError(summaries)
             elif output == "stderr":
@@ -117,6 +362,15 @@ class Controller:
                 print("unrecognized output format")
                 print(summaries)
 
+    def check_texts(self, output="stderr", findings_path=None, workers=1):
+        """
+        Check every letter, on `workers` processes; with `findings_path`, all findings are written to that JSONL file
+        as they are found
+        """
+        checkers = self.get_checkers(findings_path=findings_path)
+        self.check_all(checkers, self.iter_pieces() if workers <= 1 else self.iter_texts(), workers=workers)
+        self.report(checkers, output=output)
+
 
 if __name__ == '__main__':
     arg_parser = argparse.ArgumentParser()
@@ -126,7 +380,18 @@ if __name__ == '__main__':
     arg_parser.add_argument('--dialect', default=None, type=str)
     arg_parser.add_argument('--langtool_server', default=None, type=str)
     arg_parser.add_argument('--new_spellings', default='', type=str)
+    arg_parser.add_argument('--langtool_concurrency', default=4, type=int,
+                            help='letters checked by the LanguageTool server at the same time')
+    arg_parser.add_argument('--grammar_cache', default=os.path.expanduser('~/.cache/template-filler/grammar'),
+                            type=str, help="directory caching LanguageTool results; '' to disable")
+    arg_parser.add_argument('--langtool_segment', default='sentence', choices=['paragraph', 'sentence', 'none'],
+                            help='check every distinct paragraph or sentence only once across the letters')
     arg_parser.add_argument('--match_policy', default='ask', type=str)
+    arg_parser.add_argument('--chunksize', default=None, type=int,
+                            help='stream eval.csv in chunks of this many rows and write letters as they are filled')
+    arg_parser.add_argument('--workers', default=1, type=int, help='processes that render and write the letters')
+    arg_parser.add_argument('--seed', default=None, type=int,
+                            help='batch seed; the same seed gives the same letters for any number of workers')
     args = arg_parser.parse_args()
     post_processors = []
     if args.dialect:
@@ -136,7 +401,8 @@ if __name__ == '__main__':
 
     flock_fetcher = FlockFetcher("./flock")
     program_fetcher = ProjectInfoFetcher("./program_info")
-    student_fetcher = StudentFetcher(root_dir=".", name_list_path="eval.csv", flock_fetcher=flock_fetcher)
+    student_fetcher = StudentFetcher(root_dir=".", name_list_path="eval.csv", flock_fetcher=flock_fetcher,
+                                     chunksize=args.chunksize)
     former = GenreFormer("./genre")
 
     writer = DocxInsertionWriter(template_path="./style.docx", pre_para_id=args.pre_para_id,
@@ -147,17 +413,22 @@ if __name__ == '__main__':
             language = 'en-US'
         else:
             language = 'en-GB'
-        student_fetcher.set_cache()
-        names = set(student_fetcher.cache.first_name).union(set(student_fetcher.cache.last_name))
+        first_names, last_names = student_fetcher.collect_names()
+        names = first_names.union(last_names)
         new_spellings = args.new_spellings.split() + list(names)
         print('new spellings:', new_spellings)
         tool = langtool.LanguageTool(language=language, remote_server=args.langtool_server, newSpellings=new_spellings)
+        cache = GrammarCache(args.grammar_cache) if args.grammar_cache else None
+        tool = GrammarChecker(tool, concurrency=args.langtool_concurrency, cache=cache, new_spellings=new_spellings,
+                              segment=None if args.langtool_segment == 'none' else args.langtool_segment)
         grammar_writer = TxtWriter()
     else:
         tool, grammar_writer = None, None
 
     controller = Controller(genre_former=former, student_fetcher=student_fetcher, program_fetcher=program_fetcher,
-                            post_processors=post_processors)
-    controller.check_texts()
+                            post_processors=post_processors, streaming=args.chunksize is not None, seed=args.seed)
     controller.write_to_disk(output_writer=writer, output_dir="./output", language_tool=tool,
-                             grammar_writer=grammar_writer, match_policy=args.match_policy)
+                             grammar_writer=grammar_writer, match_policy=args.match_policy, check_output="stderr",
+                             workers=args.workers)
+    if tool and tool.cache:
+        print('grammar cache:', tool.cache.stats())
@@ -1,20 +1,45 @@
 import sys
 import os
+import string
 import numpy as np
 import pandas as pd
 import warnings
 from abc import abstractmethod
-from io_utils import read_textfile
+from io_utils import LOCAL_FS
 from parser import Parser, nonempty_segments
-from blob import get_block_constructor, Block, Atom, get_blank
-from global_utils import capitalize
+from blob import get_block_constructor, Block, Atom, get_blank, get_atom, BoundBlob
 from data import AtomicData
-from collections import Counter, defaultdict
+
+GENDERS = ['M', 'F']
+GRADES = ['A', 'B', 'C', 'D']
+ASCII_LOWERCASE = list(string.ascii_lowercase)
+NAME_CHUNKSIZE = 10000
+PRONOUNS = {
+    'M': {'he': 'he', 'him': 'him', 'his': 'his', 'himself': 'himself'},
+    'F': {'he': 'she', 'him': 'her', 'his': 'her', 'himself': 'herself'},
+}
+PRONOUN_ATOMS = {
+    gender: {**{tag: get_atom(p) for tag, p in d.items()},
+             **{tag.capitalize(): get_atom(p.capitalize()) for tag, p in d.items()}}
+    for gender, d in PRONOUNS.items()
+}
+
+
+def student_rng(seed, index):
+    """
+    Random stream of the `index`-th student of a batch seeded with `seed`, independent of the order in which students
+    are drawn; the global numpy state if `seed` is None
+    """
+    if seed is None:
+        return np.random
+    return np.random.RandomState([seed, index])
 
 
 class Fetcher:
-    def __init__(self, root_dir):
+    def __init__(self, root_dir, fs=None):
         self.root_dir = root_dir
+        # a `FileSystem` the files under `root_dir` are read from, the local one by default
+        self.fs = fs or LOCAL_FS
         self.cache = {}
 
     @abstractmethod
@@ -25,59 +50,94 @@ class Fetcher:
         self.cache = {}
 
 
+class LeastUsedSampler:
+    """
+    Draws uniformly among the least used of `n` choices in O(1).
+
+    Usage counts never differ by more than one, so the choices are kept in a single array whose first `n_available`
+    entries are the less used ones; a drawn choice is swapped to the end of that range. Once every choice has been
+    used equally often the range is reset to the whole array, i.e. the choices are drained and a new round begins.
+    """
+    __slots__ = ("order", "n_available")
+
+    def __init__(self, n):
+        self.order = list(range(n))
+        self.n_available = n
+
+    @property
+    def drained(self):
+        return self.n_available == 0
+
+    def draw(self, rng=np.random):
+        if self.drained:
+            self.n_available = len(self.order)
+        i = rng.randint(self.n_available)
+        last = self.n_available - 1
+        self.order[i], self.order[last] = self.order[last], self.order[i]
+        self.n_available = last
+        return self.order[last]
+
+
 class FlockFetcher(Fetcher):
-    def __init__(self, root_dir):
-        super(FlockFetcher, self).__init__(root_dir=root_dir)
-        self.mutex_counters = defaultdict(Counter)
+    def __init__(self, root_dir, fs=None):
+        super(FlockFetcher, self).__init__(root_dir=root_dir, fs=fs)
+        self.mutex_samplers = {}
+        self.templates = {}
 
     def clear_cache(self):
         super(FlockFetcher, self).clear_cache()
-        self.mutex_counters = defaultdict(Counter)
+        self.mutex_samplers = {}
+        self.templates = {}
 
-    def sample(self, col, cls, mutex=None):
+    def get_possibilities(self, col, cls):
+        """Distinct phrases of `col`/`cls`.txt, in file order"""
         fpath = os.path.join(self.root_dir, col, cls + ".txt")
-        if fpath in self.cache:
-            possibilities = self.cache[fpath]
-        else:
-            text = read_textfile(fpath)
-            possibilities = {poss.strip() for poss in text.split('\n') if len(poss.strip()) != 0}
-            self.cache[fpath] = possibilities
+        if fpath not in self.cache:
+            text = self.fs.read_text(fpath)
+            self.cache[fpath] = tuple(dict.fromkeys(poss.strip() for poss in text.split('\n') if poss.strip()))
+        return self.cache[fpath]
+
+    def get_templates(self, col, cls, sample_type='paragraph', wrap_with="block"):
+        """Parse every phrase of `col`/`cls`.txt once, the first time it is needed; returns {phrase: template}"""
+        key = (col, cls, sample_type, wrap_with)
+        if key not in self.templates:
+            parser = Parser()
+            block_constructor = get_block_constructor(wrap_with)
+            self.templates[key] = {
+                phrase: block_constructor([parser.parse(phrase, ret_type=sample_type)], atomic=False)
+                for phrase in self.get_possibilities(col, cls)
+            }
+        return self.templates[key]
 
-        if not mutex:
-            return np.random.choice(list(possibilities))
+    def sample(self, col, cls, mutex=None, rng=np.random):
+        possibilities = self.get_possibilities(col, cls)
 
-        counter = self.mutex_counters[(mutex, col, cls)]
+        if not mutex:
+            return possibilities[rng.randint(len(possibilities))]
 
-        if list(counter.elements()):
-            assert max(counter.values()) - min(counter.values()) <= 1
-            _, most_used_value = counter.most_common(n=1)[0]
-            most_used_keys = {k for k, v in counter.items() if v == most_used_value}
-        else:
-            most_used_keys = set()
+        key = (mutex, col, cls)
+        if key not in self.mutex_samplers:
+            self.mutex_samplers[key] = LeastUsedSampler(len(possibilities))
+        sampler = self.mutex_samplers[key]
 
-        new_possibilities = possibilities - most_used_keys
-        print(f'Using mutex = {mutex}, {len(new_possibilities)}/{len(possibilities)} available '
+        print(f'Using mutex = {mutex}, {sampler.n_available}/{len(possibilities)} available '
               f'for {col.capitalize()}-{cls.capitalize()}')
-        if not new_possibilities:
+        if sampler.drained:
             print(f'Warning: choices drained for mutex == {mutex}, col == {col}, cls == {cls}, ')
-            new_possibilities = possibilities
-
-        choice = np.random.choice(list(new_possibilities))
-        counter[choice] += 1
 
-        return choice
+        return possibilities[sampler.draw(rng)]
 
-    def fetch(self, tag, col, cls, sample_type='paragraph', wrap_with="block", mutex=None):
-        sample = self.sample(col, cls, mutex)
-        parser = Parser()
-        parsed_samples = [parser.parse(sample, ret_type=sample_type)]
-        block_constructor = get_block_constructor(wrap_with)
-        return {tag: block_constructor(parsed_samples, atomic=False)}
+    def fetch(self, tag, col, cls, sample_type='paragraph', wrap_with="block", mutex=None, rng=np.random):
+        templates = self.get_templates(col, cls, sample_type=sample_type, wrap_with=wrap_with)
+        sample = self.sample(col, cls, mutex, rng=rng)
+        # the parsed templates are shared by all students, so they are handed out as (unfilled) bound views
+        return {tag: BoundBlob(templates[sample])}
 
 
 class ProjectInfoFetcher(Fetcher):
-    def __init__(self, root_dir, description_path=None, signature_path=None, date_path=None, program_name_path=None):
-        super(ProjectInfoFetcher, self).__init__(root_dir=root_dir)
+    def __init__(self, root_dir, description_path=None, signature_path=None, date_path=None, program_name_path=None,
+                 fs=None):
+        super(ProjectInfoFetcher, self).__init__(root_dir=root_dir, fs=fs)
         if description_path is None:
             description_path = "program_description.txt"
         if signature_path is None:
@@ -92,25 +152,25 @@ class ProjectInfoFetcher(Fetcher):
         self.date_path = os.path.join(root_dir, date_path)
         self.program_name_path = os.path.join(root_dir, program_name_path)
 
-    def sample_from_cache(self):
+    def sample_from_cache(self, rng=np.random):
         ret = {}
         for k in self.cache:
             v = self.cache[k]
             if isinstance(v, (list, tuple)):
-                v = np.random.choice(v)
+                v = v[rng.randint(len(v))]
             ret[k] = v
         return ret
 
-    def fetch(self, verbatim=False):
+    def fetch(self, verbatim=False, rng=np.random):
         if len(self.cache) == 0:
             self.set_cache(verbatim=verbatim)
-        return self.sample_from_cache()
+        return self.sample_from_cache(rng=rng)
 
     def set_cache(self, verbatim=True):
-        description = read_textfile(self.description_path)
-        signature = read_textfile(self.signature_path)
-        date = nonempty_segments(read_textfile(self.date_path), "\n")
-        program_name = read_textfile(self.program_name_path)
+        description = self.fs.read_text(self.description_path)
+        signature = self.fs.read_text(self.signature_path)
+        date = nonempty_segments(self.fs.read_text(self.date_path), "\n")
+        program_name = self.fs.read_text(self.program_name_path)
 
         if verbatim:
             description = Atom(description)
@@ -136,12 +196,13 @@ class ProjectInfoFetcher(Fetcher):
 
 
 class StudentFetcher(Fetcher):
-    def __init__(self, root_dir, name_list_path, flock_fetcher):
-        super(StudentFetcher, self).__init__(root_dir=root_dir)
+    def __init__(self, root_dir, name_list_path, flock_fetcher, chunksize=None, fs=None):
+        super(StudentFetcher, self).__init__(root_dir=root_dir, fs=fs)
         if name_list_path is None:
             name_list_path = "name_list.txt"
 
         self.name_list_path = os.path.join(self.root_dir, name_list_path)
+        self.chunksize = chunksize
         self.cache = None
         self.basic_columns = [
             'first_name',
@@ -155,41 +216,107 @@ class StudentFetcher(Fetcher):
         self.additional_columns = []
         self.flock_fetcher = flock_fetcher  # type: FlockFetcher
 
-    def set_cache(self):
-        if not os.path.isfile(self.name_list_path):
+    def read_frames(self, chunksize=None, columns=None):
+        """
+        Yield the csv as validated frames of at most `chunksize` rows (a single frame if None), so that only one
+        chunk is in memory at a time; if `columns` is given, only those columns are read and preprocessed
+        """
+        if not self.fs.isfile(self.name_list_path):
             raise FileNotFoundError(f"{self.name_list_path} is not a file")
+        # mutex ids are kept as text so that every chunk groups students the same way
+        kwargs = dict(dtype={'mutex': str}, usecols=(lambda col: col in columns) if columns else None)
         try:
-            self.cache = pd.read_csv(self.name_list_path)
+            with self.fs.open(self.name_list_path) as f:
+                if chunksize is None:
+                    frames = [pd.read_csv(f, **kwargs)]
+                else:
+                    frames = pd.read_csv(f, chunksize=chunksize, **kwargs)
+                for frame in frames:
+                    self._check_columns(frame, columns or self.basic_columns)
+                    for col in columns or self.basic_columns:
+                        self._preprocess_column(frame, col)
+                    if not columns:
+                        self.additional_columns = [col for col in frame.columns if col not in self.basic_columns]
+                        self.check_rows(frame)
+                    yield frame
         except UnicodeDecodeError as e:
             raise ValueError(f"Unrecognized-encoding format; please encode the csv file in UTF-8 "
                              f"(default encoding on macOS and Linux)."
                              f"\nFor windows users, please paste to Google Sheet and download a CSV from there."
                              f"\n{e}")
 
-        for col in self.basic_columns:
-            if col not in self.cache.columns:
-                raise ValueError(f"'{col}' not found in {self.name_list_path}; "
-                                 f"check these table header again: \n {self.cache.columns}")
-            self._preprocess_column(col)
-
-        self.additional_columns = [col for col in self.cache.columns if col not in self.basic_columns]
-        self.check_rows()
+    def set_cache(self):
+        self.cache, = self.read_frames()
 
     def clear_cache(self):
         self.cache = None
 
-    def _preprocess_column(self, col_name):
-        self.cache[col_name] = self.cache[col_name].apply(lambda g: capitalize(g.strip()))
-
-    def check_rows(self):
-        for i, row in self.cache.iterrows():
-            if row['gender'] not in ['M', 'F']:
-                raise ValueError(f"Unknown gender {row} for {row['first_name']} {row['last_name']} found")
-            for col in ['assignment', 'participation', 'final', 'overall']:
-                if row[col] not in ['A', 'B', 'C', 'D']:
-                    raise ValueError(f"Unknown {col} grade '{row[col]}' for {row['first_name']} {row['last_name']}")
-
-    def fetch_flock(self, row, col, type='sentence'):
+    def _check_columns(self, frame, columns):
+        for col in columns:
+            if col not in frame.columns:
+                raise ValueError(f"'{col}' not found in {self.name_list_path}; "
+                                 f"check these table header again: \n {frame.columns}")
+
+    @staticmethod
+    def _line_numbers(mask):
+        # line 1 of the csv is the header; chunks keep counting the index where the previous one stopped
+        return [int(i) + 2 for i in mask.index[mask.to_numpy()]]
+
+    def _preprocess_column(self, frame, col_name):
+        column = frame[col_name]
+        is_str = column.map(type).eq(str)
+        if not is_str.all():
+            raise ValueError(f"Expected text in column '{col_name}', but got "
+                             f"{', '.join(repr(v) for v in column[~is_str].head(5))} "
+                             f"at line(s) {self._line_numbers(~is_str)}")
+        column = column.str.strip()
+        # only ascii lowercase initials are capitalized, as in `global_utils.capitalize`
+        lower = column.str[:1].isin(ASCII_LOWERCASE)
+        if lower.any():
+            column[lower] = column[lower].str[:1].str.upper() + column[lower].str[1:]
+        frame[col_name] = column
+
+    def check_rows(self, frame=None):
+        """Validate genders and grades of every row at once; all invalid entries are reported in a single error"""
+        frame = self.cache if frame is None else frame
+        errors = []
+        checks = [('gender', 'gender', GENDERS)] + [(col, f'{col} grade', GRADES)
+                                                    for col in ['assignment', 'participation', 'final', 'overall']]
+        for col, what, valid in checks:
+            bad = ~frame[col].isin(valid)
+            rows = frame[bad]
+            errors += [(line, f"line {line}: unknown {what} '{value}' for {first} {last}")
+                       for line, value, first, last in zip(self._line_numbers(bad), rows[col], rows['first_name'],
+                                                           rows['last_name'])]
+        if errors:
+            raise ValueError(f"{len(errors)} invalid entries found in {self.name_list_path}:\n"
+                             + "\n".join(msg for _, msg in sorted(errors)))
+
+    def iter_rows(self, frame=None):
+        """Rows of a frame (the cache by default) as plain dicts, zipped from the columns; far cheaper than the
+        Series `iterrows` yields"""
+        frame = self.cache if frame is None else frame
+        columns = list(frame.columns)
+        for values in zip(*(frame[col].tolist() for col in columns)):
+            yield dict(zip(columns, values))
+
+    def collect_names(self):
+        """Sets of all first and last names, gathered chunk by chunk from the name columns only"""
+        first_names, last_names = set(), set()
+        frames = [self.cache] if self.cache is not None else \
+            self.read_frames(self.chunksize or NAME_CHUNKSIZE, columns=['first_name', 'last_name'])
+        for frame in frames:
+            first_names.update(frame['first_name'])
+            last_names.update(frame['last_name'])
+        return first_names, last_names
+
+    def count(self):
+        """The number of students, counted chunk by chunk from the first name column only"""
+        frames = [self.cache] if self.cache is not None else \
+            self.read_frames(self.chunksize or NAME_CHUNKSIZE, columns=['first_name'])
+        return sum(len(frame) for frame in frames)
+
+    def fetch_flock(self, row, col, type='sentence', rng=np.random):
         if type == 'sentence':
             prefix = 'sent'
         elif type == 'paragraph':
@@ -201,53 +328,58 @@ class StudentFetcher(Fetcher):
             mutex = str(mutex).strip()
 
         return self.flock_fetcher.fetch(tag=f'{prefix}_{col}', col=col, cls=row[col].lower(), wrap_with='paragraph',
-                                        mutex=mutex)
+                                        mutex=mutex, rng=rng)
 
-    def fetch_row(self, row):
+    def fetch_row(self, row, rng=np.random):
         d = {
             'first_name': Atom(row['first_name']),
             'last_name': Atom(row['last_name']),
-            'he': Atom('he' if row['gender'] == "M" else 'she'),
-            'him': Atom('him' if row['gender'] == "M" else 'her'),
-            'his': Atom('his' if row['gender'] == "M" else 'her'),
-            'himself': Atom('himself' if row['gender'] == "M" else 'herself'),
-            'He': Atom('He' if row['gender'] == "M" else 'She'),
-            'Him': Atom('Him' if row['gender'] == "M" else 'Her'),
-            'His': Atom('His' if row['gender'] == "M" else 'Her'),
-            'Himself': Atom('Himself' if row['gender'] == "M" else 'Herself'),
+            **PRONOUN_ATOMS['M' if row['gender'] == "M" else 'F'],
         }
 
         for col in ['participation', 'overall', 'assignment', 'final']:
-            slot_data = self.fetch_flock(row, col, type='sentence')
-            for k in slot_data:
-                slot_data[k].fill_(d)
-            d.update(slot_data)
+            slot_data = self.fetch_flock(row, col, type='sentence', rng=rng)
+            d.update({k: v.fill(d) for k, v in slot_data.items()})
 
         parser = Parser()
         for col in self.additional_columns:
             slot_data = parser.parse_by_tag(col, str(row[col]))
-            for k in slot_data:
-                slot_data[k].fill_(d)
-            d.update(slot_data)
+            d.update({k: v.fill(d) for k, v in slot_data.items()})
 
         return d
 
     def fetch(self):
-        if self.cache is None:
-            self.set_cache()
-
-        return [self.fetch_row(row) for i, row in self.cache.iterrows()]
+        return [d for batch in self.iter_batches() for d in batch]
+
+    def iter_row_batches(self):
+        """
+        Yield the rows as lists of dicts of at most `chunksize`; in chunked mode the csv is streamed and only one chunk
+        of it is held at a time
+        """
+        if self.chunksize is None or self.cache is not None:
+            if self.cache is None:
+                self.set_cache()
+            yield list(self.iter_rows())
+            return
+        for frame in self.read_frames(self.chunksize):
+            yield list(self.iter_rows(frame))
+
+    def iter_batches(self):
+        """Yield the students' fill dicts, batched as in `iter_row_batches`"""
+        for rows in self.iter_row_batches():
+            yield [self.fetch_row(row) for row in rows]
 
 
 class GenreFormer:
-    def __init__(self, root_dir, genre_path=None):
+    def __init__(self, root_dir, genre_path=None, fs=None):
         self.root_dir = root_dir
+        self.fs = fs or LOCAL_FS
         if genre_path is None:
             genre_path = "genre.txt"
         self.genre_path = os.path.join(self.root_dir, genre_path)
 
     def get_genre(self):
-        genre = read_textfile(self.genre_path)
+        genre = self.fs.read_text(self.genre_path)
         parser = Parser()
         genre = parser.parse_article(genre)
         return genre
@@ -1,44 +1,124 @@
 import os
-import shutil
+import json
+import hashlib
+import threading
 from fetcher import FlockFetcher, ProjectInfoFetcher, GenreFormer, StudentFetcher
 from controller import Controller
-from io_utils import safe_mkdir, extract_zip, zipdir, DocxInsertionWriter, TxtWriter
-from global_utils import rreplace, get_time_str
+from grammar import GrammarChecker
+from io_utils import safe_mkdir, DocxInsertionWriter, TxtWriter, Archive, ZipFileSystem
+from global_utils import get_time_str
+from jobs import QueueFull
 import language_tool_python as langtool
 
+STUDENT_CHUNKSIZE = 1000
+
 
 class FileSystemManager:
-    def __init__(self, zip_dir, extracted_dir, download_dir):
+    def __init__(self, zip_dir, download_dir, workers=1, grammar_cache=None, max_member_size=64 * 2 ** 20):
         safe_mkdir(zip_dir)
-        safe_mkdir(extracted_dir)
         safe_mkdir(download_dir)
 
         self.ZIP_DIR = zip_dir
-        self.EXTRACTED_DIR = extracted_dir
         self.DOWNLOAD_DIR = download_dir
+        self.workers = workers
+        self.grammar_cache = grammar_cache
+        self.max_member_size = max_member_size
 
     def save_uploaded(self, file, filename):
         uploaded_zip_path = os.path.join(self.ZIP_DIR, filename)
         file.save(uploaded_zip_path)
         return uploaded_zip_path
 
+    def receive(self, file, filename):
+        """Save an upload under a name of its own, which its download will have too; returns (name, saved path)"""
+        time_str, n = get_time_str(), 1
+        unique = f"{time_str}_{filename}"
+        while not self._claim(unique):
+            n += 1
+            unique = f"{time_str}-{n}_{filename}"
+        try:
+            return unique, self.save_uploaded(file, unique)
+        except BaseException:
+            os.remove(os.path.join(self.ZIP_DIR, unique))
+            raise
+
+    def _claim(self, name):
+        """Whether `name` was free and is now taken by an empty file in `ZIP_DIR`"""
+        if os.path.exists(os.path.join(self.DOWNLOAD_DIR, name)):
+            return False
+        try:
+            # created only if absent, so that uploads received within the same second never end up with one name
+            os.close(os.open(os.path.join(self.ZIP_DIR, name), os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            return False
+        return True
+
+    @staticmethod
+    def upload_key(uploaded_zip_path, pre_para_id=0, check=True, post_processors=None, lang=None, new_words='',
+                   seed=None):
+        """A hash of the content of an upload and of the options it is to be generated with, once normalized"""
+        digest = hashlib.sha256()
+        with open(uploaded_zip_path, "rb") as f:
+            for block in iter(lambda: f.read(2 ** 20), b""):
+                digest.update(block)
+        options = {
+            "pre_para_id": int(pre_para_id),
+            "check": bool(check),
+            "post_processors": [[type(p).__name__, p.options()] for p in post_processors or []],
+            "lang": lang or None,
+            # new words only matter to the spelling checker, and not in any order
+            "new_words": sorted(set(new_words.split())) if lang else [],
+            "seed": seed,
+        }
+        digest.update(json.dumps(options, sort_keys=True).encode())
+        return digest.hexdigest()
+
+    def _result_path(self, key):
+        return os.path.join(self.DOWNLOAD_DIR, ".results", key)
+
+    def find_result(self, key):
+        """The download generated earlier for `key` (see `upload_key`), if it is still in DOWNLOAD_DIR, else None"""
+        try:
+            with open(self._result_path(key)) as f:
+                filename = f.read()
+        except FileNotFoundError:
+            return None
+        if os.path.isfile(os.path.join(self.DOWNLOAD_DIR, filename)):
+            return filename
+        os.remove(self._result_path(key))
+        return None
+
+    def remember_result(self, key, filename):
+        safe_mkdir(os.path.dirname(self._result_path(key)))
+        # written aside and moved in place, so that readers never see half a name
+        tmp = f"{self._result_path(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "w") as f:
+            f.write(filename)
+        os.replace(tmp, self._result_path(key))
+
     @staticmethod
-    def get_controller(project_root, post_processors=None):
-        flock_fetcher = FlockFetcher(os.path.join(project_root, "flock"))
-        program_fetcher = ProjectInfoFetcher(os.path.join(project_root, "program_info"))
-        student_fetcher = StudentFetcher(root_dir=project_root, name_list_path="eval.csv", flock_fetcher=flock_fetcher)
-        former = GenreFormer(os.path.join(project_root, "genre"))
+    def get_controller(project_root, post_processors=None, chunksize=STUDENT_CHUNKSIZE, seed=None, fs=None):
+        """A controller of the project at `project_root`, read from the `FileSystem` `fs` (the local one by default)"""
+        flock_fetcher = FlockFetcher(os.path.join(project_root, "flock"), fs=fs)
+        program_fetcher = ProjectInfoFetcher(os.path.join(project_root, "program_info"), fs=fs)
+        student_fetcher = StudentFetcher(root_dir=project_root, name_list_path="eval.csv", flock_fetcher=flock_fetcher,
+                                         chunksize=chunksize, fs=fs)
+        former = GenreFormer(os.path.join(project_root, "genre"), fs=fs)
         return Controller(genre_former=former, student_fetcher=student_fetcher, program_fetcher=program_fetcher,
-                          post_processors=post_processors)
+                          post_processors=post_processors, streaming=chunksize is not None, seed=seed)
 
     @staticmethod
-    def run_controller(project_root, controller, pre_para_id, lang=None, new_words=''):
-        writer = DocxInsertionWriter(template_path=os.path.join(project_root, "style.docx"), pre_para_id=pre_para_id)
+    def run_controller(project_root, controller, pre_para_id, lang=None, new_words='', check_output=None, workers=1,
+                       grammar_cache=None, archive=None, fs=None, progress=None):
+        """
+        Write the letters under project_root/output, or, given an `Archive` of that directory, straight into it;
+        `progress(n)` is called once n letters are written
+        """
+        writer = DocxInsertionWriter(template_path=os.path.join(project_root, "style.docx"), pre_para_id=pre_para_id,
+                                     fs=fs)
         output_dir = os.path.join(project_root, "output")
         if lang:
-            controller.student_fetcher.set_cache()
-            first_names = set(controller.student_fetcher.cache.first_name)
-            last_names = set(controller.student_fetcher.cache.last_name)
+            first_names, last_names = controller.student_fetcher.collect_names()
             names = list(first_names.union(last_names))
             new_spellings = names + new_words.split()
             print('new spellings:', new_spellings)
@@ -47,34 +127,79 @@ class FileSystemManager:
                 remote_server=os.environ.get('LANGTOOL_SERVER', 'http://localhost:8010'),
                 newSpellings=new_spellings,
             )
+            tool = GrammarChecker(tool, concurrency=int(os.environ.get('LANGTOOL_CONCURRENCY', 4)),
+                                  cache=grammar_cache, new_spellings=new_spellings,
+                                  segment=os.environ.get('LANGTOOL_SEGMENT', 'sentence') or None)
             gwriter = TxtWriter()
         else:
             tool, gwriter = None, None
+        if archive is not None:
+            writer = archive.writer(writer)
+            gwriter = gwriter and archive.writer(gwriter)
         controller.write_to_disk(writer, output_dir=output_dir, language_tool=tool, grammar_writer=gwriter,
-                                 match_policy='all')
+                                 match_policy='all', check_output=check_output, workers=workers, progress=progress)
+        if tool and grammar_cache:
+            print('grammar cache:', grammar_cache.stats())
         return output_dir
 
-    def handle(self, file, filename, pre_para_id, check=True, post_processors=None, lang=None, new_words=''):
-        # save uploaded zip, and get the dir
-        filename = f"{get_time_str()}_{filename}"
-        uploaded_zip_path = self.save_uploaded(file, filename)
-
-        # extract zip to a new folder
-        extracted_path = os.path.join(self.EXTRACTED_DIR, rreplace(filename, ".zip", ""))
-        extract_zip(src=uploaded_zip_path, dest=extracted_path)
-        os.remove(uploaded_zip_path)
-
-        # instantiate a controller to handle the extracted folder
-        controller = self.get_controller(extracted_path, post_processors=post_processors)
-        if check:
-            controller.check_texts(output="raise")
+    def submit(self, jobs, file, filename, pre_para_id, check=True, post_processors=None, lang=None, new_words='',
+               seed=None):
+        """
+        Save an upload and queue a job on the `JobQueue` `jobs` generating its letters (see `process`), unless the same
+        upload was generated with the same options before, or is being generated still. Returns (the name of the
+        download generated before, None) or (None, the `Job` generating it); raises `QueueFull` if too many jobs wait.
+        """
+        filename, uploaded_zip_path = self.receive(file, filename)
+        options = dict(pre_para_id=pre_para_id, check=check, post_processors=post_processors, lang=lang,
+                       new_words=new_words, seed=seed)
+        key = self.upload_key(uploaded_zip_path, **options)
+        found = self.find_result(key)
+        if found is not None:
+            os.remove(uploaded_zip_path)
+            return found, None
+        try:
+            job, submitted = jobs.submit_once(key, self.process, uploaded_zip_path, filename, key=key, **options)
+        except QueueFull:
+            os.remove(uploaded_zip_path)
+            raise
+        if not submitted:
+            # the job already generating the same upload has a copy of its own
+            os.remove(uploaded_zip_path)
+        return None, job
 
-        # run the controller and generator docs, optionally gather error, info, debug
-        output_dir = self.run_controller(extracted_path, controller, pre_para_id, lang=lang, new_words=new_words)
+    def process(self, uploaded_zip_path, filename, pre_para_id, check=True, post_processors=None, lang=None,
+                new_words='', seed=None, key=None, progress=None):
+        """
+        Generate the letters of a saved upload into the download `filename`, which is returned, and remembered as the
+        result of `key` if given. `progress(stage, done, total)`, if given, is told of the 'reading', 'writing'
+        (letter by letter) and 'finishing' stages.
+        """
+        progress = progress or (lambda *args: None)
+        progress('reading')
+        # the project is read from the zip in place, member by member, and nothing else is extracted
+        fs = ZipFileSystem(uploaded_zip_path, max_member_size=self.max_member_size)
 
-        # zip the docs folder and return download path
+        # run the controller and generate docs in a single pass, straight into the download zip, checking them on the
+        # way if asked to; failed checks are raised once all letters are through. The zip is only put in place whole.
         download_path = os.path.join(self.DOWNLOAD_DIR, filename)
-        zipdir(output_dir, download_path)
-        shutil.rmtree(extracted_path)
+        partial_path = download_path + ".part"
+        try:
+            controller = self.get_controller("", post_processors=post_processors, seed=seed, fs=fs)
+            total = controller.student_fetcher.count()
+            progress('writing', 0, total)
+            with Archive(partial_path, root="output") as archive:
+                self.run_controller("", controller, pre_para_id, lang=lang, new_words=new_words,
+                                    check_output="raise" if check else None, workers=self.workers,
+                                    grammar_cache=self.grammar_cache, archive=archive, fs=fs,
+                                    progress=lambda n: progress('writing', n, total))
+                progress('finishing', total, total)
+            os.replace(partial_path, download_path)
+            if key is not None:
+                self.remember_result(key, filename)
+        finally:
+            fs.close()
+            os.remove(uploaded_zip_path)
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
 
         return filename
@@ -0,0 +1,71 @@
+"""
+Synthetic projects for the tests and benchmarks: a genre, flock phrases, program info and an eval.csv of any number of
+students, as a folder or an uploaded zip, and a docx template to insert letters into.
+"""
+import os
+import zipfile
+import numpy as np
+from docx import Document
+
+GRADES = ["a", "b", "c", "d"]
+COLUMNS = ["participation", "overall", "assignment", "final"]
+
+GENRE = """Dear admissions committee,
+It is my pleasure to recommend __first_name__ __last_name__ for the program. __he__ joined my course last year.
+__program_description__
+__sent_participation__ __sent_assignment__ In addition, __his__ final project was among the best I have seen. __sent_final__
+__sent_overall__ I recommend __him__ without any reservation, and I am confident __he__ will excel.
+Sincerely,
+__program_name__
+"""
+
+PHRASES = [
+    "__He__ did {grade}-level {col} work and __his__ effort showed in every single session of the course.",
+    "{col} was a real strength for __him__, and __he__ earned a solid {grade} for it.",
+    "__first_name__ applied __himself__ to {col} throughout the term and received a grade of {grade}.",
+    "Whenever {col} came up, __he__ was ready, which is reflected in __his__ {grade}.",
+]
+
+
+def make_project(root, n_students):
+    os.makedirs(os.path.join(root, "genre"))
+    os.makedirs(os.path.join(root, "program_info"))
+    with open(os.path.join(root, "genre", "genre.txt"), "w") as f:
+        f.write(GENRE)
+    for col in COLUMNS:
+        os.makedirs(os.path.join(root, "flock", col))
+        for grade in GRADES:
+            with open(os.path.join(root, "flock", col, grade + ".txt"), "w") as f:
+                f.write("\n".join(p.format(col=col, grade=grade) for p in PHRASES))
+    for fname, text in [
+        ("program_description.txt", "A summer program on machine learning. Students build projects."),
+        ("instructor_signature.txt", "Professor X"),
+        ("date.txt", "June 2020\nJuly 2020"),
+        ("program_name.txt", "Machine Learning"),
+    ]:
+        with open(os.path.join(root, "program_info", fname), "w") as f:
+            f.write(text)
+
+    rng = np.random.RandomState(0)
+    with open(os.path.join(root, "eval.csv"), "w") as f:
+        f.write("first_name,last_name,gender,assignment,participation,final,overall\n")
+        for i in range(n_students):
+            grades = ",".join(rng.choice(GRADES, size=4)).upper()
+            f.write(f"first{i},last{i},{rng.choice(['M', 'F'])},{grades}\n")
+
+
+def make_template(path):
+    doc = Document()
+    for text in ["Letterhead", "Signature", "Footer"]:
+        doc.add_paragraph(text)
+    doc.save(path)
+
+
+def zip_project(root, path):
+    """Zip the files under `root` into `path`, as a project would be uploaded"""
+    with zipfile.ZipFile(path, "w") as z:
+        for dirpath, _, files in os.walk(root):
+            for file in files:
+                file_path = os.path.join(dirpath, file)
+                if file_path != path:
+                    z.write(file_path, os.path.relpath(file_path, root))
@@ -0,0 +1,322 @@
+import os
+import re
+import copy
+import json
+import hashlib
+import threading
+import time
+import urllib.parse
+from collections import deque, OrderedDict
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from language_tool_python.match import Match
+
+try:
+    from language_tool_python.exceptions import LanguageToolError
+except ImportError:  # language_tool_python < 3
+    from language_tool_python.utils import LanguageToolError
+
+
+SEGMENT_RES = {
+    # lines, without surrounding whitespace
+    'paragraph': re.compile(r"\S(?:[^\n]*\S)?"),
+    # runs up to a sentence end (with any closing quotes or brackets) or the end of the line
+    'sentence': re.compile(r"\S(?:[^\n]*?[.!?][\"'”’)\]]*(?=\s|$)|[^\n]*\S)?", re.MULTILINE),
+}
+
+
+# common first and last names by whether they start with a vowel, so that "a" or "an" before a name is judged the same
+# with its stand-in, then by length; all of them known to the spell checker
+STAND_INS = (
+    {True: {2: "Al", 3: "Ann", 4: "Anna", 5: "Alice", 6: "Alexis", 7: "Abigail", 8: "Angelina", 9: "Alexander",
+            10: "Antoinette"},
+     False: {2: "Jo", 3: "Ben", 4: "John", 5: "James", 6: "Robert", 7: "Michael", 8: "Jennifer", 9: "Stephanie",
+             10: "Jacqueline"}},
+    {True: {4: "Owen", 5: "Evans", 6: "Austin", 7: "Edwards", 8: "Anderson", 9: "Armstrong"},
+     False: {2: "Li", 3: "Lee", 4: "Long", 5: "Lopez", 6: "Miller", 7: "Johnson", 8: "Williams", 9: "Robertson",
+             10: "Richardson"}},
+)
+
+
+def _starts_with_vowel(name):
+    return name[:1].upper() in "AEIOU"
+
+
+def _word_re(word):
+    return re.compile(rf"(?<!\w){re.escape(word)}(?!\w)")
+
+
+def mask_names(text, names):
+    """
+    Replace every occurrence of the (first, last) `names` in `text` by a common name of the same length and initial
+    sound, so that letters differing only in the student's name share their segments while all offsets stay valid and
+    the same rules apply. Returns the masked text and the {stand-in: name} replacements made.
+    """
+    replaced = {}
+    for name, stand_ins in zip(names, STAND_INS):
+        stand_in = stand_ins[_starts_with_vowel(name)].get(len(name))
+        if stand_in is None or stand_in == name or _word_re(stand_in).search(text):
+            continue
+        text, n = _word_re(name).subn(stand_in, text)
+        if n:
+            replaced[stand_in] = name
+    return text, replaced
+
+
+def unmask_names(s, replaced):
+    for stand_in, name in replaced.items():
+        s = _word_re(stand_in).sub(name, s)
+    return s
+
+
+def unmask_match(match, text, masked, replaced):
+    """
+    Put the original `text` back into a `match` found in `masked`: its context and sentence are pieces of `masked` at
+    known offsets (stand-ins having the lengths of the names), and its replacements only name the student if the error
+    itself covers a name.
+    """
+    start = match.offset - match.offset_in_context
+    # the characters that line up with `masked`, i.e. not the "..." a long context is cut with
+    match.context = "".join(text[i] if 0 <= i < len(text) and masked[i] == c else c
+                            for i, c in enumerate(match.context, start))
+    sentence = getattr(match, 'sentence', None)
+    if sentence:
+        start = masked.find(sentence, max(match.offset + match.error_length - len(sentence), 0))
+        if 0 <= start <= match.offset:
+            match.sentence = text[start:start + len(sentence)]
+    end = match.offset + match.error_length
+    if text[match.offset:end] != masked[match.offset:end]:
+        match.replacements = [unmask_names(r, replaced) for r in match.replacements]
+
+
+def split_segments(text, segment=None):
+    """(offset, segment) pairs of `text` split into 'paragraph's or 'sentence's; the whole text if `segment` is None"""
+    if segment is None:
+        return [(0, text)]
+    return [(m.start(), m.group()) for m in SEGMENT_RES[segment].finditer(text)]
+
+
+class GrammarCache:
+    """
+    On-disk cache of the raw matches LanguageTool reports, one json file per key under `root`.
+
+    Every hit refreshes the modification time of the entry's file; entries left unused for `ttl` seconds are dropped,
+    and once the entries take more than `max_bytes`, the least recently used ones are evicted down to 90% of it.
+    """
+
+    def __init__(self, root, max_bytes=256 * 2 ** 20, ttl=30 * 24 * 3600):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._size = sum(path.stat().st_size for path in self._entries())
+
+    @staticmethod
+    def key(*parts):
+        return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+    def _entries(self):
+        return self.root.glob("*/*.json")
+
+    def _path(self, key):
+        return self.root / key[:2] / f"{key}.json"
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, key):
+        """The cached value of `key`, or None"""
+        path = self._path(key)
+        try:
+            if time.time() - path.stat().st_mtime > self.ttl:
+                self._remove(path)
+                raise FileNotFoundError(path)
+            with open(path) as f:
+                value = json.load(f)
+            os.utime(path)
+        except (FileNotFoundError, ValueError):
+            self._count(hit=False)
+            return None
+        self._count(hit=True)
+        return value
+
+    def put(self, key, value):
+        path = self._path(key)
+        path.parent.mkdir(exist_ok=True)
+        data = json.dumps(value).encode()
+        # written aside and moved in place, so readers never see half an entry
+        tmp = path.with_name(f"{key}.{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp.write_bytes(data)
+        with self._lock:
+            # an entry written over only adds what it grew by
+            try:
+                old_size = path.stat().st_size
+            except FileNotFoundError:
+                old_size = 0
+            os.replace(tmp, path)
+            self._size += len(data) - old_size
+            full = self._size > self.max_bytes
+        if full:
+            self.evict()
+
+    def _remove(self, path):
+        try:
+            size = path.stat().st_size
+            path.unlink()
+        except FileNotFoundError:
+            return
+        with self._lock:
+            self._size -= size
+            self.evictions += 1
+
+    def evict(self):
+        """Drop expired entries, then the least recently used ones until at most 90% of `max_bytes` are taken"""
+        entries = []
+        for path in self._entries():
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        with self._lock:
+            self._size = sum(size for _, size, _ in entries)
+        now = time.time()
+        for mtime, size, path in entries:
+            if now - mtime <= self.ttl and self._size <= 0.9 * self.max_bytes:
+                break
+            self._remove(path)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "bytes": self._size}
+
+
+class GrammarChecker:
+    """
+    Checks texts against the (remote) server of a `LanguageTool` with up to `concurrency` requests in flight.
+
+    Every worker thread keeps its own session, so connections are kept alive between letters. A request that times
+    out, cannot connect or is answered with 429/5xx is retried up to `retries` times, after waiting `backoff`,
+    2 * `backoff`, 4 * `backoff`... seconds. Matches are built in the calling thread, in the order the texts came in.
+
+    With a `GrammarCache`, the matches are looked up by a hash of the text, the request options (language, rules),
+    `new_spellings` and the server's version, and only texts never seen before go to the server.
+
+    With `segment` = 'paragraph' or 'sentence', `iter_check` splits every text into lines or sentences and sends each
+    distinct segment only once, however many letters share it (the `memo_size` most recent ones are remembered);
+    its matches are shifted to every letter's offsets. Rules that look across segments, e.g. repeated sentence
+    starts, are then out of reach. Given `names`, the student's own names are masked first (see `mask_names`).
+    """
+    RETRY_STATUS = {429, 500, 502, 503, 504}
+
+    def __init__(self, language_tool, concurrency=4, timeout=30, retries=3, backoff=0.5, cache=None,
+                 new_spellings=(), segment=None, memo_size=4096):
+        self.language_tool = language_tool
+        self.url = urllib.parse.urljoin(language_tool._url, "check")
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.cache = cache  # type: GrammarCache
+        self.segment = segment
+        self.memo_size = memo_size
+        self._local = threading.local()
+        if cache is not None:
+            options = {k: v for k, v in language_tool._create_params("").items() if k != "text"}
+            self._cache_context = [options, sorted(set(new_spellings)), self.server_version()]
+
+    @classmethod
+    def wrap(cls, language_tool, **kwargs):
+        return language_tool if isinstance(language_tool, cls) else cls(language_tool, **kwargs)
+
+    def _session(self):
+        if not hasattr(self._local, 'session'):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def server_version(self):
+        software = self._post("")["software"]
+        return " ".join(str(software.get(k, "")) for k in ["name", "version", "buildDate"])
+
+    def query(self, text):
+        """The raw matches the server reports for `text`"""
+        if self.cache is None:
+            return self._post(text)['matches']
+        key = self.cache.key(text, *self._cache_context)
+        matches = self.cache.get(key)
+        if matches is None:
+            matches = self._post(text)['matches']
+            self.cache.put(key, matches)
+        return matches
+
+    def _post(self, text):
+        params = self.language_tool._create_params(text)
+        for attempt in range(self.retries + 1):
+            try:
+                response = self._session().post(self.url, data=params, timeout=self.timeout)
+                if response.status_code not in self.RETRY_STATUS:
+                    response.raise_for_status()
+                    return response.json()
+                error = requests.HTTPError(f"{response.status_code} {response.reason}", response=response)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            if attempt < self.retries:
+                time.sleep(self.backoff * 2 ** attempt)
+        raise LanguageToolError(f"{self.url}: {error}") from error
+
+    def check(self, text):
+        return [Match(m, text) for m in self.query(text)]
+
+    def _submit(self, pool, memo, text):
+        """[future, matches] of a segment, submitting it unless it is remembered in `memo`"""
+        if text in memo:
+            memo.move_to_end(text)
+            return memo[text]
+        entry = memo[text] = [pool.submit(self.query, text), None]
+        if len(memo) > self.memo_size:
+            memo.popitem(last=False)
+        return entry
+
+    @staticmethod
+    def _collect(text, masked, segments, entries, replaced):
+        matches = []
+        for (offset, segment), entry in zip(segments, entries):
+            if entry[1] is None:
+                entry[1] = [Match(m, segment) for m in entry[0].result()]
+            for match in entry[1]:
+                match = copy.copy(match)
+                match.offset += offset
+                if replaced:
+                    unmask_match(match, text, masked, replaced)
+                matches.append(match)
+        return matches
+
+    def iter_check(self, pairs, names=None):
+        """
+        Check the texts of (item, text) pairs concurrently; yields (item, text, matches) in the same order.
+        `names(item)`, if given, returns the (first, last) names of the student to mask in the text.
+        """
+        pending = deque()
+        memo = OrderedDict()
+        with ThreadPoolExecutor(self.concurrency) as pool:
+            for item, text in pairs:
+                masked, replaced = mask_names(text, names(item)) if names else (text, {})
+                segments = split_segments(masked, self.segment)
+                entries = [self._submit(pool, memo, s) for _, s in segments]
+                pending.append((item, text, masked, segments, entries, replaced))
+                # read ahead a little so that the pool stays busy while earlier results are consumed
+                if len(pending) >= 2 * self.concurrency:
+                    item, text, masked, segments, entries, replaced = pending.popleft()
+                    yield item, text, self._collect(text, masked, segments, entries, replaced)
+            while pending:
+                item, text, masked, segments, entries, replaced = pending.popleft()
+                yield item, text, self._collect(text, masked, segments, entries, replaced)
@@ -1,10 +1,15 @@
+import io
 import os
 import sys
+import copy
+import time
 import zipfile
+import posixpath
 from pathlib import Path
 from docx import Document
 from docx.text.paragraph import Paragraph
 from docx.oxml.xmlchemy import OxmlElement
+from docx.opc.oxml import serialize_part_xml
 from docx.shared import Pt
 from abc import abstractmethod
 
@@ -50,41 +55,162 @@ def zipdir(src, dest):
                     zip.write(filename, arcname)
 
 
+class FileSystem:
+    """Where the inputs of a project are read from; paths are those of the local filesystem, or relative to its root"""
+
+    @abstractmethod
+    def open(self, path):
+        """A binary file object of the file at `path`"""
+        pass
+
+    @abstractmethod
+    def isfile(self, path):
+        pass
+
+    def read_bytes(self, path):
+        with self.open(path) as f:
+            return f.read()
+
+    def read_text(self, path):
+        return read_textfile(path)
+
+
+class LocalFileSystem(FileSystem):
+    def open(self, path):
+        return open(path, "rb")
+
+    def isfile(self, path):
+        return os.path.isfile(path)
+
+
+class ZipFileSystem(FileSystem):
+    """
+    Reads the members of a zip file in place, from its path or its bytes, without extracting anything else: paths
+    are taken relative to the root of the archive. A member of more than `max_member_size` bytes cannot be read.
+    """
+
+    def __init__(self, source, max_member_size=64 * 2 ** 20):
+        self.source = source
+        self.max_member_size = max_member_size
+        self._zip = None
+        self._pid = None
+
+    def __getstate__(self):
+        # reopened wherever it is unpickled, e.g. in a spawned pool worker
+        return dict(self.__dict__, _zip=None, _pid=None)
+
+    @property
+    def zip(self):
+        # a forked pool worker inherits the open file and its offset, which the parent keeps moving: it opens its own
+        if self._zip is None or self._pid != os.getpid():
+            source = io.BytesIO(self.source) if isinstance(self.source, bytes) else self.source
+            self._zip = zipfile.ZipFile(source)
+            self._pid = os.getpid()
+        return self._zip
+
+    @staticmethod
+    def member_name(path):
+        return posixpath.normpath(str(path).replace(os.sep, "/")).lstrip("/")
+
+    def _info(self, path):
+        try:
+            info = self.zip.getinfo(self.member_name(path))
+        except KeyError:
+            where = self.source if isinstance(self.source, str) else 'zip'
+            raise FileNotFoundError(f"{path} is not a file in {where}")
+        if info.is_dir():
+            raise FileNotFoundError(f"{path} is a directory")
+        # a member never reads past the size it declares, so checking that size is enough
+        if info.file_size > self.max_member_size:
+            raise ValueError(f"{path} is too large: {info.file_size} bytes, more than {self.max_member_size}")
+        return info
+
+    def open(self, path):
+        return self.zip.open(self._info(path))
+
+    def isfile(self, path):
+        try:
+            self._info(path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def read_text(self, path):
+        # newlines translated as `open` does
+        with io.TextIOWrapper(self.open(path)) as f:
+            return f.read()
+
+    def close(self):
+        if self._zip is not None:
+            self._zip.close()
+            self._zip = self._pid = None
+
+
+LOCAL_FS = LocalFileSystem()
+
+
 class Writer:
+    # the extension of the files written
+    suffix = ""
+
     def _safe_mkdir(self, fname):
         safe_mkdir(os.path.dirname(fname) or '.')
 
+    def _fname(self, fname):
+        fname = str(fname)
+        return fname if fname.endswith(self.suffix) else fname + self.suffix
+
+    @staticmethod
+    def _as_text(content):
+        # content is either a str or a (bound) Blob that is serialized here
+        return content if isinstance(content, str) else content.serialize()
+
     @abstractmethod
-    def write(self, content, fname):
+    def render(self, content) -> bytes:
+        """The bytes of the file of `content`"""
         pass
 
+    def write(self, content, fname):
+        self.save(self.render(content), fname)
+
+    def save(self, data, fname):
+        """Write the `data` of a `render`ed file"""
+        self._safe_mkdir(fname)
+        with open(self._fname(fname), "wb") as f:
+            f.write(data)
+
 
 class TxtWriter(Writer):
+    suffix = ".txt"
+
+    def render(self, content):
+        return self._as_text(content).encode()
+
     def write(self, content, fname):
         self._safe_mkdir(fname)
-        fname = str(fname)
-        if not fname.endswith(".txt"):
-            fname += '.txt'
-        with open(fname, 'w') as f:
-            f.write(content)
+        with open(self._fname(fname), 'w') as f:
+            if isinstance(content, str):
+                f.write(content)
+            else:
+                content.serialize_to(f)
 
 
 class DocxWriter(Writer):
-    def write(self, content, fname):
-        self._safe_mkdir(fname)
-        fname = str(fname)
-        if not fname.endswith(".docx"):
-            fname += ".docx"
+    suffix = ".docx"
+
+    def render(self, content):
         doc = Document()
         style = doc.styles['Normal']
         font = style.font
         font.name = 'Times New Roman'
         font.size = Pt(12)
 
-        for para in content.split("\n"):
+        for para in self._as_text(content).split("\n"):
             doc.add_paragraph(para)
 
-        doc.save(fname)
+        out = io.BytesIO()
+        doc.save(out)
+        return out.getvalue()
 
 
 def docx_insert_paragraph_after(paragraph, text=None, style=None):
@@ -100,33 +226,150 @@ def docx_insert_paragraph_after(paragraph, text=None, style=None):
 
 
 class DocxInsertionWriter(Writer):
-    def __init__(self, template_path, pre_para_id, insert_before=True):
+    """
+    Writes every letter into a copy of the docx template, as paragraphs around its `pre_para_id`-th paragraph.
+
+    The template is loaded and prepared once: its parts other than the document's body are zipped once, with fixed
+    timestamps, and every letter only adds its body, cloned from the parsed template, to a copy of that zip.
+    """
+    suffix = ".docx"
+    # zip entries get a fixed time, so that the same letter makes the same file
+    DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+    def __init__(self, template_path, pre_para_id, insert_before=True, fs=None):
         self.template_path = template_path
         self.pre_para_id = pre_para_id
         self.insert_before = insert_before
-
-    def write(self, content, fname):
-        self._safe_mkdir(fname)
-        fname = str(fname)
-        if not fname.endswith(".docx"):
-            fname += ".docx"
-        doc = Document(self.template_path)
+        # the `FileSystem` the template is read from
+        self.fs = fs or LOCAL_FS
+        self._prepared = None
+
+    def __getstate__(self):
+        # what is prepared is rebuilt wherever the writer is unpickled, e.g. in a pool worker
+        return dict(self.__dict__, _prepared=None)
+
+    def _zip_info(self, name):
+        info = zipfile.ZipInfo(name, date_time=self.DATE_TIME)
+        info.compress_type = zipfile.ZIP_DEFLATED
+        return info
+
+    def prepare(self):
+        """(zipped parts, document part name, document element, index of the paragraph, paragraph to clone)"""
+        if self._prepared is not None:
+            return self._prepared
+        doc = Document(io.BytesIO(self.fs.read_bytes(self.template_path)))
         style = doc.styles['Normal']
         font = style.font
         font.name = 'Times New Roman'
         font.size = Pt(12)
 
         pre_para = doc.paragraphs[self.pre_para_id]
-
-        if self.insert_before:
-            for para_text in content.split("\n"):
-                pre_para.insert_paragraph_before(text=para_text, style=style)
-        else:
-            for para_text in content.split("\n")[::-1]:
-                docx_insert_paragraph_after(pre_para, text=para_text, style=style)
-
-        print(f"saving to {fname}")
-        doc.save(fname)
+        # an empty paragraph inserted just like those of the letters, which are cloned from it
+        new_p = pre_para.insert_paragraph_before(style=style)._p
+        new_p.getparent().remove(new_p)
+        index = list(doc.element.body).index(pre_para._p)
+
+        saved = io.BytesIO()
+        doc.save(saved)
+        part_name = doc.part.partname.membername
+        parts = io.BytesIO()
+        with zipfile.ZipFile(saved) as src, zipfile.ZipFile(parts, "w") as dest:
+            for name in src.namelist():
+                if name != part_name:
+                    dest.writestr(self._zip_info(name), src.read(name))
+        self._prepared = parts.getvalue(), part_name, doc.element, index, new_p
+        return self._prepared
+
+    def render(self, content):
+        parts, part_name, element, index, new_p = self.prepare()
+        content = self._as_text(content)
+        element = copy.deepcopy(element)
+        pre_p = element.body[index]
+        for para_text in content.split("\n") if self.insert_before else content.split("\n")[::-1]:
+            p = copy.deepcopy(new_p)
+            if para_text:
+                Paragraph(p, None).add_run(para_text)
+            if self.insert_before:
+                pre_p.addprevious(p)
+            else:
+                pre_p.addnext(p)
+
+        out = io.BytesIO(parts)
+        with zipfile.ZipFile(out, "a") as z:
+            z.writestr(self._zip_info(part_name), serialize_part_xml(element))
+        return out.getvalue()
+
+    def save(self, data, fname):
+        print(f"saving to {self._fname(fname)}")
+        super(DocxInsertionWriter, self).save(data, fname)
+
+
+class Archive:
+    """
+    A zip file that writers write into instead of a directory: what would go to a path under `root` goes to the same
+    path relative to the parent of `root`, as `zipdir(root, path)` would put it. Files of formats that are compressed
+    already are stored as they are, the others deflated. Entries are written one at a time, and only by this process.
+    """
+    STORED_SUFFIXES = (".docx", ".xlsx", ".pptx", ".zip", ".gz", ".png", ".jpg", ".jpeg", ".pdf")
+
+    def __init__(self, path, root):
+        self.path = path
+        self.relroot = os.path.abspath(os.path.join(root, os.pardir))
+        self.zip = zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED)
+        self._dirs = set()
+
+    def arcname(self, fname):
+        return os.path.relpath(os.path.abspath(fname), self.relroot).replace(os.sep, "/")
+
+    def _add_dirs(self, arcname):
+        # directory entries, as `zipdir` writes them
+        parts = arcname.split("/")[:-1]
+        for i in range(1, len(parts) + 1):
+            name = "/".join(parts[:i]) + "/"
+            if name not in self._dirs:
+                self._dirs.add(name)
+                self.zip.writestr(zipfile.ZipInfo(name, date_time=time.localtime()[:6]), b"")
+
+    def writestr(self, fname, data):
+        arcname = self.arcname(fname)
+        self._add_dirs(arcname)
+        info = zipfile.ZipInfo(arcname, date_time=time.localtime()[:6])
+        info.compress_type = zipfile.ZIP_STORED if arcname.lower().endswith(self.STORED_SUFFIXES) else \
+            zipfile.ZIP_DEFLATED
+        self.zip.writestr(info, data)
+
+    def move(self, path, fname):
+        """Add the file at `path` as `fname`, and remove it"""
+        with open(path, "rb") as f:
+            self.writestr(fname, f.read())
+        os.remove(path)
+
+    def writer(self, writer):
+        return ArchiveWriter(writer, self)
+
+    def close(self):
+        self.zip.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ArchiveWriter(Writer):
+    """Writes what `writer` would into an `Archive`"""
+
+    def __init__(self, writer, archive):
+        self.writer = writer
+        self.archive = archive
+        self.suffix = writer.suffix
+
+    def render(self, content):
+        return self.writer.render(content)
+
+    def save(self, data, fname):
+        self.archive.writestr(self._fname(fname), data)
 
 
 def stdio_yn(q):
@@ -0,0 +1,113 @@
+import threading
+import time
+import traceback
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class QueueFull(Exception):
+    pass
+
+
+class Job:
+    """
+    A task run in the background. Its `state` goes from 'queued' to 'running', then 'done' with a `result` or
+    'failed' with an `error`; while running, the task reports its `stage` and the progress in it as `done` of `total`.
+    """
+
+    def __init__(self):
+        self.id = uuid.uuid4().hex
+        self.key = None
+        self.state = 'queued'
+        self.stage = None
+        self.done = 0
+        self.total = None
+        self.result = None
+        self.error = None
+        self.traceback = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self._lock = threading.Lock()
+
+    def progress(self, stage, done=0, total=None):
+        with self._lock:
+            self.stage, self.done, self.total = stage, done, total
+
+    def to_dict(self):
+        with self._lock:
+            return {k: getattr(self, k) for k in ['id', 'state', 'stage', 'done', 'total', 'result', 'error',
+                                                  'traceback', 'created', 'started', 'finished']}
+
+
+class JobQueue:
+    """
+    Runs jobs on `concurrency` threads, with at most `max_queued` more waiting for one; beyond that, `submit` raises
+    `QueueFull`. Finished jobs can be looked up until `keep` more recent ones have finished.
+    """
+
+    def __init__(self, concurrency=1, max_queued=8, keep=100):
+        self.concurrency = concurrency
+        self.max_queued = max_queued
+        self.keep = keep
+        self.jobs = {}
+        # {key: job} of the jobs submitted with a key that are not through yet
+        self._in_flight = {}
+        self._finished = deque()
+        self._queued = 0
+        self._lock = threading.RLock()
+        self._pool = ThreadPoolExecutor(concurrency, thread_name_prefix="job")
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Queue `fn(*args, progress=job.progress, **kwargs)`, whose return value is the result of the job; returns the
+        `Job`
+        """
+        job = Job()
+        with self._lock:
+            if self._queued >= self.max_queued:
+                raise QueueFull(f"{self._queued} jobs are waiting already")
+            self._queued += 1
+            self.jobs[job.id] = job
+        self._pool.submit(self._run, job, fn, args, kwargs)
+        return job
+
+    def submit_once(self, job_key, fn, *args, **kwargs):
+        """
+        Like `submit`, unless a job of the same `job_key` is still queued or running: returns (that job, False) then,
+        and (the new job, True) otherwise
+        """
+        with self._lock:
+            job = self._in_flight.get(job_key)
+            if job is not None:
+                return job, False
+            job = self.submit(fn, *args, **kwargs)
+            job.key = job_key
+            self._in_flight[job_key] = job
+        return job, True
+
+    def get(self, job_id):
+        """The `Job` of `job_id`, or None"""
+        return self.jobs.get(job_id)
+
+    def _run(self, job, fn, args, kwargs):
+        with self._lock:
+            self._queued -= 1
+        job.state, job.started = 'running', time.time()
+        try:
+            job.result = fn(*args, progress=job.progress, **kwargs)
+            job.state = 'done'
+        except Exception as e:
+            job.error, job.traceback = str(e), traceback.format_exc()
+            job.state = 'failed'
+        job.finished = time.time()
+        with self._lock:
+            if job.key is not None:
+                self._in_flight.pop(job.key, None)
+            self._finished.append(job.id)
+            while len(self._finished) > self.keep:
+                self.jobs.pop(self._finished.popleft(), None)
+
+    def shutdown(self, wait=True):
+        self._pool.shutdown(wait=wait)
@@ -0,0 +1,132 @@
+"""
+A stand-in for a LanguageTool server, for tests and benchmarks.
+
+    python langtool_stub.py [--port 8010] [--latency 0.05] [--fail_every 0]
+
+It answers `GET /v2/languages` and `POST /v2/check` like the real server, but only knows two rules: "teh" is
+misspelled and a word must not be repeated. Every answer is delayed by `latency` seconds, and with `fail_every`
+set to n, every n-th check is answered with a 503 to exercise retries (only once per text, so retrying succeeds).
+"""
+import argparse
+import json
+import re
+import threading
+import time
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+VERSION = "1.0"
+LANGUAGES = [
+    {"name": "English (US)", "code": "en", "longCode": "en-US"},
+    {"name": "English (GB)", "code": "en", "longCode": "en-GB"},
+]
+RULES = [
+    (re.compile(r"\bteh\b"), lambda m: "the",
+     {"id": "MORFOLOGIK_RULE_EN_US", "description": "Possible spelling mistake", "issueType": "misspelling",
+      "category": {"id": "TYPOS", "name": "Possible Typo"}}, "Possible spelling mistake found."),
+    (re.compile(r"\b(\w+) \1\b", re.IGNORECASE), lambda m: m.group(1),
+     {"id": "ENGLISH_WORD_REPEAT_RULE", "description": "Word repetition", "issueType": "duplication",
+      "category": {"id": "MISC", "name": "Miscellaneous"}}, "Possible typo: you repeated a word"),
+]
+
+
+def find_matches(text):
+    matches = []
+    for regex, replacement, rule, message in RULES:
+        for m in regex.finditer(text):
+            lower, upper = max(m.start() - 20, 0), min(m.end() + 20, len(text))
+            matches.append({
+                "message": message,
+                "shortMessage": "",
+                "replacements": [{"value": replacement(m)}],
+                "offset": m.start(),
+                "length": m.end() - m.start(),
+                "context": {"text": text[lower:upper], "offset": m.start() - lower, "length": m.end() - m.start()},
+                "sentence": text,
+                "type": {"typeName": "Other"},
+                "rule": rule,
+                "ignoreForIncompleteSentence": False,
+                "contextForSureMatch": 0,
+            })
+    return sorted(matches, key=lambda m: m["offset"])
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive
+    disable_nagle_algorithm = True  # headers and body go out in separate writes
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, body):
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        if self.path.split("?")[0] == "/v2/languages":
+            self._reply(200, LANGUAGES)
+        else:
+            self._reply(404, {"error": self.path})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        params = urllib.parse.parse_qs(self.rfile.read(length).decode(), keep_blank_values=True)
+        if self.path != "/v2/check":
+            return self._reply(404, {"error": self.path})
+
+        server = self.server  # type: StubServer
+        text = params.get("text", [""])[0]
+        fail = server.count_request(self.client_address, text)
+        time.sleep(server.latency)
+        if fail:
+            return self._reply(503, {"error": "try again"})
+        self._reply(200, {"software": {"name": "LanguageTool stub", "version": VERSION},
+                          "language": {"code": params.get("language", [""])[0]},
+                          "matches": find_matches(text)})
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0.0, fail_every=0):
+        super(StubServer, self).__init__(("127.0.0.1", port), StubHandler)
+        self.latency = latency
+        self.fail_every = fail_every
+        self.n_checks = 0
+        self.clients = set()
+        self.failed = set()
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def count_request(self, client_address, text):
+        """Count a check request; returns whether it is to fail"""
+        with self._lock:
+            self.n_checks += 1
+            self.clients.add(client_address)
+            if self.fail_every and self.n_checks % self.fail_every == 0 and text not in self.failed:
+                self.failed.add(text)
+                return True
+            return False
+
+    def start(self):
+        """Serve from a daemon thread; returns self"""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--port', default=8010, type=int)
+    arg_parser.add_argument('--latency', default=0.05, type=float)
+    arg_parser.add_argument('--fail_every', default=0, type=int)
+    args = arg_parser.parse_args()
+    server = StubServer(port=args.port, latency=args.latency, fail_every=args.fail_every)
+    print(f"LanguageTool stub listening on {server.url}")
+    server.serve_forever()
@@ -3,12 +3,22 @@ import string
 import warnings
 from blob import Blob, Blank, Block
 from blob import Article, Paragraph, Sentence, Atom
-from blob import get_blank
+from blob import get_blank, get_atom
 
 SENTENCE_TAG = "__(sent_.*?)__"
 PARAGRAPH_TAG = "__(para_.*?)__"
 ANY_TAG = "__(.*?)__"
 
+SENTENCE_TAG_RE = re.compile(SENTENCE_TAG)
+PARAGRAPH_TAG_RE = re.compile(PARAGRAPH_TAG)
+ANY_TAG_RE = re.compile(ANY_TAG)
+WHITESPACE_RE = re.compile(f"[{re.escape(string.whitespace)}]")
+
+# A paragraph is lexed in a single scan into runs of spaces, dots, text, tags, stray underscores and other
+# whitespace. Text never contains "__", so a tag is tried wherever one may start, as `re.findall(ANY_TAG, word)` does.
+TOKEN_RE = re.compile(r"(?P<space> +)|(?P<dot>\.)|(?P<text>(?:[^\s._]|_(?!_))+)|__(?P<tag>[^\s.]*?)__|(?P<under>_+)"
+                      r"|(?P<ws>[^\S ]+)")
+
 
 def nonempty_segments(s, sep):
     segments = s.split(sep)
@@ -20,10 +30,11 @@ def check_no_whitespace(s):
     if isinstance(s, (list, tuple)):
         for ss in s:
             check_no_whitespace(ss)
+        return
 
-    for whs in string.whitespace:
-        if whs in s:
-            raise ValueError(f"whitespace {repr(whs)} found in {s}")
+    match = WHITESPACE_RE.search(s)
+    if match:
+        raise ValueError(f"whitespace {repr(match.group())} found in {s}")
 
 
 def check_no_linebreak(s):
@@ -51,27 +62,129 @@ def placeholder_unpad(s):
 
 
 def split_sentences(s: str):
+    # only the regex path (see `lexes_cleanly`) gets here, with odd runs of underscores that a single substitution
+    # would split differently: each tag is padded, checked and dotted wherever it occurs, one after the other
     trailing_dot = s.endswith(".")
-    tags = re.findall(SENTENCE_TAG, s)
-    for t in tags:
-        old = placeholder_pad(t)
-        new = old + "."
-        s = s.replace(old, new)
-
+    for tag in SENTENCE_TAG_RE.findall(s):
+        padded = placeholder_pad(tag)
+        s = s.replace(padded, padded + ".")
     sentences = nonempty_segments(s, ".")
-    sentences = [sent + "." if len(re.findall(SENTENCE_TAG, sent)) == 0 else sent for sent in sentences]
+    sentences = [sent + "." if SENTENCE_TAG_RE.search(sent) is None else sent for sent in sentences]
     if not trailing_dot and sentences[-1].endswith("."):
         sentences[-1] = sentences[-1][:-1]
     return sentences
 
 
+def tokenize(s):
+    """Lex `s` in one scan into (space, dot, text, tag, underscores, other whitespace) tuples; one of them is set."""
+    return TOKEN_RE.findall(s)
+
+
+def lexes_cleanly(s, tokens):
+    """
+    Whether every "__" in `s` delimits one of the lexed tags, and the regexes `SENTENCE_TAG` and `PARAGRAPH_TAG` match
+    just those tags. Only then do the tokens agree with the regexes `ANY_TAG`, `SENTENCE_TAG` and `PARAGRAPH_TAG`
+    applied level by level (runs like "____", tags that contain spaces or dots, or a tag's closing "__" followed by
+    "sent_" or "para_" text are matched differently at different levels).
+    """
+    if "___" in s:
+        return False
+    spans, start = set(), 0
+    for token in tokens:
+        tag = token[3]
+        length = len(tag) + 4 if tag else len("".join(token))
+        if tag:
+            spans.add((start, start + length))
+        start += length
+    if s.count("__") != 2 * len(spans):
+        return False
+    return all(m.span() in spans for regex in (SENTENCE_TAG_RE, PARAGRAPH_TAG_RE) for m in regex.finditer(s))
+
+
+class TagToken(str):
+    """A tag inside a word, as opposed to plain text."""
+    __slots__ = ()
+
+
+def group_tokens(tokens, dot_ends_sentence=True):
+    """
+    Group tokens into sentences of stripped, non-empty words, like `split_sentences` and `nonempty_segments` do.
+    A word is a str, or a list of str and `TagToken` pieces if it contains a tag. A sentence ends at a dot and right
+    after a sentence tag; with `dot_ends_sentence=False`, dots are text. Returns a list of (words, sentence tags).
+    """
+    sentences = []
+    words, sent_tags = [], []
+    word, word_has_ws = "", False
+    for space, dot, text, tag, under, ws in tokens:
+        if tag:
+            is_sentence_tag = tag.startswith("sent_")
+            if is_sentence_tag:
+                sent_tags.append(tag)
+            tag = TagToken(tag)
+            if type(word) is str:
+                word = [word, tag] if word else [tag]
+            else:
+                word.append(tag)
+            if not (dot_ends_sentence and is_sentence_tag):
+                continue
+        elif not (space or (dot and dot_ends_sentence)):
+            piece = text or dot or under or ws
+            word_has_ws = word_has_ws or bool(ws)
+            if type(word) is str:
+                word += piece
+            elif isinstance(word[-1], TagToken):
+                word.append(piece)
+            else:
+                word[-1] += piece
+            continue
+
+        # the current word ends here
+        if word_has_ws:
+            word = _strip_word(word)
+        if word:
+            words.append(word)
+        word, word_has_ws = "", False
+        if not space:
+            sentences.append((words, sent_tags))
+            words, sent_tags = [], []
+
+    if word_has_ws:
+        word = _strip_word(word)
+    if word:
+        words.append(word)
+    sentences.append((words, sent_tags))
+    return sentences
+
+
+def _strip_word(word):
+    if type(word) is str:
+        word = word.strip()
+        pieces = [word]
+    else:
+        if not isinstance(word[0], TagToken):
+            word[0] = word[0].lstrip()
+        if not isinstance(word[-1], TagToken):
+            word[-1] = word[-1].rstrip()
+        word = pieces = [piece for piece in word if piece or isinstance(piece, TagToken)]
+    for piece in pieces:
+        if not isinstance(piece, TagToken) and WHITESPACE_RE.search(piece):
+            check_no_whitespace(_join_word(word))
+    return word
+
+
+def _join_word(word):
+    if type(word) is str:
+        return word
+    return "".join(placeholder_pad(piece) if isinstance(piece, TagToken) else piece for piece in word)
+
+
 class Parser:
     def parse_word(self, s, allow_space=False):
         if not allow_space:
             check_no_whitespace(s)
-        tags = re.findall(ANY_TAG, s)
+        tags = ANY_TAG_RE.findall(s)
         if len(tags) == 0:
-            return Atom(s)
+            return get_atom(s)
 
         elif len(tags) == 1:
             padded = placeholder_pad(tags[0])
@@ -80,13 +193,58 @@ class Parser:
                 return blank
             else:
                 seg1, seg2 = s.split(padded)
-                return Block([Atom(seg1), blank, Atom(seg2)], atomic=False, separator="")
+                return Block([get_atom(seg1), blank, get_atom(seg2)], atomic=False, separator="")
         else:
             raise ValueError(f"Multiple tags were found in the word '{s}': {tags}")
 
+    def _parse_tagged_word(self, word):
+        """Build the tree `parse_word` would build for a word given as pieces, see `group_tokens`."""
+        tags = [str(piece) for piece in word if isinstance(piece, TagToken)]
+        if len(tags) > 1:
+            raise ValueError(f"Multiple tags were found in the word '{_join_word(word)}': {tags}")
+
+        placeholder_pad(tags[0])
+        blank = get_blank(tags[0])
+        if len(word) == 1:
+            return blank
+        seg1 = "" if isinstance(word[0], TagToken) else word[0]
+        seg2 = "" if isinstance(word[-1], TagToken) else word[-1]
+        return Block([get_atom(seg1), blank, get_atom(seg2)], atomic=False, separator="")
+
+    def _parse_sentence_words(self, words, sent_tags, append_dot=False, s=None):
+        """Build a sentence from a group of `group_tokens`; `s` is the raw sentence, if it is parsed on its own."""
+        if len(sent_tags) == 0:
+            if append_dot:
+                last = words[-1]
+                if type(last) is str:
+                    words[-1] = last + "."
+                elif isinstance(last[-1], TagToken):
+                    last.append(".")
+                else:
+                    last[-1] += "."
+            return Sentence([get_atom(w) if type(w) is str else self._parse_tagged_word(w) for w in words],
+                            atomic=False)
+
+        sentence = s if s is not None else " ".join(_join_word(w) for w in words)
+        if len(sent_tags) == 1:
+            padded = placeholder_pad(sent_tags[0])
+            if padded != sentence:
+                raise ValueError(f"Bad use of sentence tag: tag={sent_tags[0]}, sentence={sentence}")
+            return get_blank(sent_tags[0])
+        else:
+            raise ValueError(f"Multiple sentence tags were found in sentence '{sentence}': {sent_tags}")
+
     def parse_sentence(self, s):
         check_no_linebreak(s)
-        tags = re.findall(SENTENCE_TAG, s)
+        tokens = tokenize(s)
+        if not lexes_cleanly(s, tokens):
+            return self._parse_sentence_by_regex(s)
+
+        [(words, sent_tags)] = group_tokens(tokens, dot_ends_sentence=False)
+        return self._parse_sentence_words(words, sent_tags, s=s)
+
+    def _parse_sentence_by_regex(self, s):
+        tags = SENTENCE_TAG_RE.findall(s)
         check_no_whitespace(tags)
 
         if len(tags) == 0:
@@ -102,7 +260,31 @@ class Parser:
 
     def parse_paragraph(self, s):
         check_no_linebreak(s)
-        tags = re.findall(PARAGRAPH_TAG, s)
+        tokens = tokenize(s)
+        all_tags = [token[3] for token in tokens if token[3]]
+        if not lexes_cleanly(s, tokens):
+            return self._parse_paragraph_by_regex(s)
+
+        tags = [tag for tag in all_tags if tag.startswith("para_")]
+        if len(tags) == 0:
+            sentences = [(words, sent_tags) for words, sent_tags in group_tokens(tokens) if words]
+            # every sentence but a sentence tag ends with a dot; the last one only if the paragraph does
+            trailing_dot = s.endswith(".")
+            if not sentences and not trailing_dot:
+                raise ValueError(f"No sentence found in paragraph '{s}'")
+            last = len(sentences) - 1
+            return Paragraph([self._parse_sentence_words(words, sent_tags, append_dot=i != last or trailing_dot)
+                              for i, (words, sent_tags) in enumerate(sentences)], atomic=False)
+        elif len(tags) == 1:
+            padded = placeholder_pad(tags[0])
+            if padded != s:
+                raise ValueError(f"Bad use of paragraph tag: tag={tags[0]}, paragraph={s}")
+            return get_blank(tags[0])
+        else:
+            raise ValueError(f"Multiple paragraph tags were found in paragraph '{s}': {tags}")
+
+    def _parse_paragraph_by_regex(self, s):
+        tags = PARAGRAPH_TAG_RE.findall(s)
         check_no_whitespace(tags)
 
         if len(tags) == 0:
@@ -118,7 +300,9 @@ class Parser:
 
     def parse_article(self, s):
         paragraphs = nonempty_segments(s, "\n")
-        return Article([self.parse_paragraph(para) for para in paragraphs], atomic=False)
+        article = Article([self.parse_paragraph(para) for para in paragraphs], atomic=False)
+        article.index_blanks()
+        return article
 
     def parse(self, s, ret_type="article"):
         if not isinstance(ret_type, str):
@@ -127,13 +311,15 @@ class Parser:
         if ret_type == "article":
             return self.parse_article(s)
         elif ret_type == "paragraph":
-            return self.parse_paragraph(s)
+            blob = self.parse_paragraph(s)
         elif ret_type == "sentence":
-            return self.parse_sentence(s)
+            blob = self.parse_sentence(s)
         elif ret_type in ["atom", "word"]:
-            return self.parse_word(s)
+            blob = self.parse_word(s)
         else:
             raise ValueError(f"Unknown ret_type: {ret_type}")
+        blob.index_blanks()
+        return blob
 
     def parse_by_tag(self, tag, s):
         if not isinstance(tag, str):
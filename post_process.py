@@ -17,6 +17,10 @@ class PostProcessor(ABC):
     def process(self, content: str) -> str:
         pass
 
+    def options(self) -> dict:
+        """What this post-processor was set up with, which with its class determines what it does"""
+        return {}
+
 
 class EnglishDialectPostProcessor(PostProcessor):
     URLs = dict(
@@ -37,6 +41,9 @@ class EnglishDialectPostProcessor(PostProcessor):
         self.d.update(d_upper)
         self.regex = '|'.join(r'\b%s\b' % re.escape(s) for s in self.d)
 
+    def options(self):
+        return {"dialect": self.dialect.lower()}
+
     def _replace(self, match):
         return self.d[match.group(0)]
 
@@ -59,5 +66,8 @@ class ApostrophePostProcessor(PostProcessor):
     def __init__(self, preference):
         self._pref = preference
 
+    def options(self):
+        return {"preference": self._pref}
+
     def process(self, content):
         return content.replace(self.other, self.preference)
@@ -1,6 +1,8 @@
+import io
 from copy import deepcopy
-from blob import Blob, Atom, Sentence, Paragraph, Article
+from blob import Blob, Block, Atom, Sentence, Paragraph, Article
 from blob import ParagraphSlot, TaggedPlaceholder, FirstNamePlaceholder
+from blob import collect_bindings, get_atom, SentenceSlot, _ATOMS
 from data import AtomicData, SequenceData
 
 b1 = Sentence(
@@ -84,8 +86,125 @@ def test_blob_cast():
     print(y.serialize())
 
 
+def test_compile():
+    x = Article(entries=[b1, b2, b3, b4])
+    program = x.compile()
+    print(program)
+    assert program is x.compile()
+    assert not program.is_static
+    assert Article(entries=[b1, b2]).compile().is_static
+
+    fills = [AtomicData("answer1", 16).to_dict(), AtomicData("first_name", "shuheng").to_dict(),
+             SequenceData("favnum", [456, 789]).to_dict()]
+    y = x
+    for d in fills:
+        y = y.fill(d)
+    assert program.render(collect_bindings(*fills)) == y.serialize()
+    assert program.render(ignore_unfilled=True) == x.serialize(ignore_unfilled=True)
+
+
+def test_fill_leaves_template():
+    x = Article(entries=[b1, b2, b3, b4])
+    before = x.serialize(ignore_unfilled=True)
+    y = x.fill(AtomicData("answer1", 16).to_dict())
+    z = y.fill(AtomicData("first_name", "shuheng").to_dict())
+    assert x.serialize(ignore_unfilled=True) == before
+    assert not y.is_filled and z.is_filled
+    assert y.list_unfilled_tags() == ["first_name", "favnum"]
+    assert z.list_unfilled_tags() == ["favnum"]
+    assert "Shuheng" in z.serialize() and "Shuheng" not in y.serialize(ignore_unfilled=True)
+
+
+def test_blank_index():
+    x = Article(entries=[b1, b2, deepcopy(b3), deepcopy(b4)])
+    index = x.blank_index
+    assert list(index) == ["first_name", "answer1", "favnum"]
+    assert x.list_unfilled_tags() == ["first_name", "answer1", "favnum"]
+
+    x.fill_(AtomicData("first_name", "shuheng").to_dict())
+    assert [len(blank.entries) for blank in index["first_name"]] == [1]
+    assert x.list_unfilled_tags() == ["answer1", "favnum"]
+    assert not x.is_filled
+
+    x.fill_(AtomicData("answer1", 16).to_dict())
+    assert x.is_filled and x.list_unfilled_tags() == ["favnum"]
+
+    # appending deep down a tree refreshes the caches of all the nodes containing it
+    inner = Sentence([get_atom("Hello")])
+    outer = Article([Paragraph([inner])])
+    assert outer.serialize() == "Hello" and outer.is_filled
+    inner.append_entry(FirstNamePlaceholder())
+    assert list(outer.blank_index) == ["first_name"] and not outer.is_filled
+    slot = ParagraphSlot(tag="favnum")
+    inner.append_entry(slot)
+    value = Sentence([get_atom("Hi")])
+    slot.append_entry(value)
+    assert outer.list_unfilled_tags() == ["first_name"]
+    value.append_entry(TaggedPlaceholder(tag="answer2"))
+    assert outer.list_unfilled_tags() == ["first_name", "answer2"]
+    # the unfilled tags are kept in the index, next to the blanks
+    assert outer.blank_index.unfilled == {"first_name": True, "answer2": True}
+    outer.fill_({**AtomicData("first_name", "shuheng").to_dict(), **AtomicData("answer2", 2).to_dict()})
+    assert outer.is_filled and outer.serialize() == "Hello Shuheng Hi 2"
+
+
+def test_compact_nodes():
+    assert get_atom("word") is get_atom("word")
+    assert deepcopy(get_atom("word")) is get_atom("word")
+    # interned atoms are dropped once unused
+    atoms = [get_atom(f"tag_{i}") for i in range(1000)]
+    assert sum(s.startswith("tag_") for s in list(_ATOMS)) == 1000
+    del atoms
+    assert not any(s.startswith("tag_") for s in list(_ATOMS))
+    for blob in [b1, b2, b3, FirstNamePlaceholder(), ParagraphSlot(tag="x"), get_atom("word")]:
+        assert not hasattr(blob, "__dict__")
+
+
+def test_streaming_serialize():
+    y = Article(entries=[b1, b2, b3, b4]).fill(AtomicData("answer1", 16).to_dict()).fill(
+        AtomicData("first_name", "shuheng").to_dict())
+    stream = io.StringIO()
+    y.serialize_to(stream)
+    assert stream.getvalue() == y.serialize()
+
+    # values nested far deeper than the recursion limit
+    root = SentenceSlot(tag="s")
+    for i in reversed(range(5000)):
+        slot, root = root, SentenceSlot(tag="s")
+        root.append_entry(Sentence([get_atom(str(i)), slot]))
+    assert root.serialize().split() == [str(i) for i in range(5000)]
+    assert root.is_filled and root.list_unfilled_tags() == ["s"]
+
+    # and blocks nested as deep
+    block = Sentence([get_atom("deep"), TaggedPlaceholder(tag="x")])
+    for i in range(5000):
+        block = Block([block])
+    assert block.list_unfilled_tags() == ["x"]
+    filled = block.fill(AtomicData("x", "down").to_dict())
+    stream = io.StringIO()
+    filled.serialize_to(stream)
+    assert stream.getvalue() == filled.serialize() == "deep down"
+
+
+def test_serialize_pieces():
+    y = Article(entries=[b1, b2, b3, b4]).fill(AtomicData("answer1", 16).to_dict()).fill(
+        AtomicData("first_name", "shuheng").to_dict()).fill(SequenceData("favnum", ["1, 2", "3"]).to_dict())
+    pieces = y.serialize_pieces()
+    assert "".join(text for text, _ in pieces) == y.serialize()
+    # the student's values, capitalized where they start a sentence, apart from the template text around them
+    assert [text for text, from_student in pieces if from_student] == ["Shuheng", "16"]
+    assert all(text for text, _ in pieces)
+    assert all(a[1] != b[1] for a, b in zip(pieces, pieces[1:]))
+
+
 if __name__ == '__main__':
     test_blob()
     test_placeholder()
     test_slot()
     test_blob_cast()
+    test_compile()
+    test_fill_leaves_template()
+    test_blank_index()
+    test_compact_nodes()
+    test_streaming_serialize()
+    test_serialize_pieces()
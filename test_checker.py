@@ -0,0 +1,99 @@
+import json
+import os
+import tempfile
+from checker import Document, CheckSummarizer, PlaceholderChecker, GenderChecker, NameChecker, ApostropheChecker, \
+    SecondPersonChecker, PieceCache
+
+TEXT = "Dear __tag__,\nI recommend Ada Lee; she said: \"your work, Ada's, isn’t done\". His you_r note."
+
+
+def test_document():
+    doc = Document(TEXT)
+    assert doc.tokens[:6] == ["Dear", "tag", "I", "recommend", "Ada", "Lee"]
+    assert doc.lower[4:6] == ["ada", "lee"]
+    assert [TEXT[l:r] for l, r in doc.spans] == doc.tokens
+    assert doc.marks == {"_", "'", "’"}
+
+    # only what is asked for
+    doc = Document(TEXT, needs=GenderChecker.needs)
+    assert doc.lower is not None and doc.tokens is None and doc.marks is None
+
+
+def test_checkers_share_document():
+    summarizer = CheckSummarizer()
+    checkers = [PlaceholderChecker([summarizer]), GenderChecker([summarizer]),
+                ApostropheChecker(summarizers=[summarizer]), SecondPersonChecker([summarizer])]
+    name_checker = NameChecker(["Ada", "Bob"], ["Lee", "Ray"], [summarizer])
+    doc = Document(TEXT, Document.needed_by(checkers + [name_checker]))
+    for checker in checkers:
+        checker.check("letter", doc)
+    name_checker.check("letter", doc, "Ada", "Lee")
+    shared = summarizer.get_summaries()
+
+    summarizer.__init__()
+    for checker in checkers:
+        checker.check("letter", TEXT)
+    name_checker.check("letter", TEXT, "Ada", "Lee")
+    assert summarizer.get_summaries() == shared
+
+    assert [(f.checker, f.code, f.detail) for f in summarizer.findings] == [
+        ("PlaceholderChecker", "unresolved-tag", "tag"), ("PlaceholderChecker", "underscore", ""),
+        ("GenderChecker", "opposite-pronoun", "his"), ("ApostropheChecker", "mixed-apostrophes", ""),
+        ("SecondPersonChecker", "second-person", "your")]
+    assert shared[2] == ('GenderChecker: in letter: pronoun "his" of the opposite gender: '
+                         '...our work, Ada\'s, isn’t done". His you_r note....')
+
+
+def test_name_checker():
+    summarizer = CheckSummarizer()
+    # more first than last names, which pairing them up used to miss
+    checker = NameChecker(["Ada", "Mary Ann", "Mary", "Bo", "Cy"], ["Lee", "Smith-Jones"], [summarizer])
+    text = "Mary Ann Lee did well, better than Cy or Bo Smith-Jones. Mary Ann Lee!"
+    checker.check("letter", text, "Mary Ann", "Lee")
+    assert [(f.code, f.detail, text[slice(*f.span)]) for f in summarizer.findings] == [
+        ("alien-first-name", "Cy", "Cy"), ("alien-first-name", "Bo", "Bo"),
+        ("alien-last-name", "Smith-Jones", "Smith-Jones")]
+
+    summarizer.__init__()
+    checker.check((3, "Mary Ann Lee"), "Mary did well.", "Mary Ann", "Lee")
+    assert summarizer.get_summaries() == [
+        'NameChecker: in letter 3 (Mary Ann Lee): alien first name "Mary" found: ...Mary did well....',
+        'NameChecker: in letter 3 (Mary Ann Lee): target first name "Mary Ann" not found',
+        'NameChecker: in letter 3 (Mary Ann Lee): target last name "Lee" not found']
+
+
+def test_findings_jsonl():
+    with tempfile.TemporaryDirectory() as root:
+        path = os.path.join(root, "findings.jsonl")
+        summarizer = CheckSummarizer(path, cap=3, keep=2)
+        checker = SecondPersonChecker([summarizer])
+        for i in range(4):
+            checker.check((i, f"Student {i}"), "You and your friends.")
+        summarizer.close()
+
+        with open(path) as f:
+            records = [json.loads(line) for line in f]
+        assert len(records) == 3
+        assert records[0] == {"checker": "SecondPersonChecker", "student": 0, "name": "Student 0",
+                              "code": "second-person", "detail": "you", "span": [0, 3],
+                              "context": "You and your friends."}
+        assert summarizer.total == 8 and len(summarizer.findings) == 2
+        assert summarizer.summary().splitlines()[3:] == [f"... and 6 more, see {path}",
+                                                         "counts: SecondPersonChecker second-person: 8"]
+
+
+def test_piece_cache():
+    cache = PieceCache([GenderChecker(verbose=False)], size=3)
+    pieces = [(f"Piece {i} by him. ", False) for i in range(5)] + [("Ada", True)]
+    letter = cache.document("".join(raw for raw, _ in pieces), pieces)
+    assert letter.lower.count("him") == 5
+    # the template pieces are bounded like the students' ones, the most recent kept
+    assert list(cache.template) == [raw for raw, _ in pieces[2:5]] and list(cache.student) == ["Ada"]
+
+
+if __name__ == '__main__':
+    test_document()
+    test_checkers_share_document()
+    test_name_checker()
+    test_findings_jsonl()
+    test_piece_cache()
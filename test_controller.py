@@ -0,0 +1,228 @@
+import os
+import tempfile
+import contextlib
+import io
+import shutil
+import threading
+import time
+import zipfile
+from fixtures import make_project, make_template, zip_project
+from fetcher import FlockFetcher, ProjectInfoFetcher, StudentFetcher, GenreFormer
+from controller import Controller
+from io_utils import TxtWriter, Archive, ZipFileSystem
+from file_manager import FileSystemManager
+from jobs import JobQueue
+from post_process import ApostrophePostProcessor
+
+
+def get_controller(root, seed=None, streaming=False, post_processors=None):
+    return Controller(
+        genre_former=GenreFormer(os.path.join(root, "genre")),
+        student_fetcher=StudentFetcher(root, "eval.csv", FlockFetcher(os.path.join(root, "flock")),
+                                       chunksize=7 if streaming else None),
+        program_fetcher=ProjectInfoFetcher(os.path.join(root, "program_info")),
+        streaming=streaming,
+        seed=seed,
+        post_processors=post_processors,
+    )
+
+
+def write_letters(controller, workers):
+    with tempfile.TemporaryDirectory() as out:
+        controller.write_to_disk(TxtWriter(), out, workers=workers)
+        letter_dir = os.path.join(out, "original-letters")
+        return {fname: open(os.path.join(letter_dir, fname)).read() for fname in os.listdir(letter_dir)}
+
+
+def test_workers_reproducible():
+    with tempfile.TemporaryDirectory() as root:
+        make_project(root, 20)
+        with contextlib.redirect_stdout(io.StringIO()):
+            letters = write_letters(get_controller(root, seed=3), workers=1)
+            assert len(letters) == 20
+            assert write_letters(get_controller(root, seed=3, streaming=True), workers=3) == letters
+            assert write_letters(get_controller(root, seed=4), workers=1) != letters
+
+
+def test_parallel_check():
+    with tempfile.TemporaryDirectory() as root:
+        make_project(root, 20)
+        controller = get_controller(root, seed=3)
+        with contextlib.redirect_stdout(io.StringIO()):
+            texts = [(row, content + " First1 Last2") for row, content in controller.iter_texts()]
+            results = []
+            for workers in [1, 3]:
+                checkers = controller.get_checkers()
+                controller.check_all(checkers, texts, workers=workers)
+                results.append((checkers['summarizer'].findings, checkers['summarizer'].counts))
+        assert results[0][0] and results[0] == results[1]
+
+
+class Hyphenate:
+    """A post-processor that looks across pieces: the space between a student's names is template text"""
+    def process(self, content):
+        return content.replace(" Last", "-Last")
+
+
+def test_check_pieces():
+    with tempfile.TemporaryDirectory() as root:
+        make_project(root, 20)
+        for post_processors in [[], [Hyphenate()]]:
+            controller = get_controller(root, seed=3, post_processors=post_processors)
+            with contextlib.redirect_stdout(io.StringIO()):
+                texts = [(row, content + " First1 Last2", pieces + [(" First1 Last2", True)])
+                         for row, content, pieces in controller.iter_pieces()]
+                results = []
+                for letters in [texts, [(row, content) for row, content, _ in texts]]:
+                    checkers = controller.get_checkers()
+                    controller.check_all(checkers, letters)
+                    results.append((checkers['summarizer'].findings, checkers['summarizer'].counts))
+            assert results[0][0] and results[0] == results[1]
+            assert [content for _, content, _ in texts] == \
+                   [content + " First1 Last2" for _, content in controller.iter_texts()]
+
+
+def test_write_to_archive():
+    with tempfile.TemporaryDirectory() as root:
+        make_project(root, 20)
+        expected = write_letters(get_controller(root, seed=3), workers=1)
+        for workers in [1, 2]:
+            path = os.path.join(root, f"letters-{workers}.zip")
+            with Archive(path, root=os.path.join(root, "output")) as archive, \
+                    contextlib.redirect_stdout(io.StringIO()):
+                get_controller(root, seed=3).write_to_disk(archive.writer(TxtWriter()), os.path.join(root, "output"),
+                                                           check_output="stdout", workers=workers)
+            assert not os.path.exists(os.path.join(root, "output"))
+            with zipfile.ZipFile(path) as z:
+                letters = {name.split("/")[-1]: z.read(name).decode() for name in z.namelist()
+                           if name.startswith("output/original-letters/") and not name.endswith("/")}
+                assert letters == expected
+                assert "output/findings.jsonl" in z.namelist()
+
+        # letters that are not all through leave no findings spooled behind
+        def interrupt(n):
+            raise RuntimeError(n)
+
+        spool, tempfile.tempdir = tempfile.tempdir, os.path.join(root, "spool")
+        os.mkdir(tempfile.tempdir)
+        try:
+            with Archive(os.path.join(root, "partial.zip"), root=os.path.join(root, "output")) as archive:
+                get_controller(root, seed=3).write_to_disk(archive.writer(TxtWriter()), os.path.join(root, "output"),
+                                                           check_output="stdout", progress=interrupt)
+        except RuntimeError:
+            assert os.listdir(os.path.join(root, "spool")) == []
+        else:
+            raise AssertionError("the progress callback should have interrupted the letters")
+        finally:
+            tempfile.tempdir = spool
+
+
+def test_zip_project():
+    with tempfile.TemporaryDirectory() as root:
+        make_project(root, 20)
+        path = os.path.join(root, "upload.zip")
+        zip_project(root, path)
+        with contextlib.redirect_stdout(io.StringIO()):
+            expected = [text for _, text in get_controller(root, seed=3).iter_texts()]
+            for chunksize in [None, 7]:
+                controller = FileSystemManager.get_controller("", chunksize=chunksize, seed=3, fs=ZipFileSystem(path))
+                assert [text for _, text in controller.iter_texts()] == expected
+
+
+def test_zip_upload_workers():
+    with tempfile.TemporaryDirectory() as root:
+        make_project(root, 20)
+        make_template(os.path.join(root, "style.docx"))
+        path = os.path.join(root, "upload.zip")
+        zip_project(root, path)
+        downloads = []
+        for workers in [1, 2]:
+            manager = FileSystemManager(os.path.join(root, f"zip{workers}"), os.path.join(root, f"download{workers}"),
+                                        workers=workers)
+            # forked workers read the upload through their own handle on it
+            uploaded_zip_path = os.path.join(manager.ZIP_DIR, "upload.zip")
+            shutil.copy(path, uploaded_zip_path)
+            with contextlib.redirect_stdout(io.StringIO()):
+                filename = manager.process(uploaded_zip_path, "upload.zip", 1, seed=3)
+            with zipfile.ZipFile(os.path.join(manager.DOWNLOAD_DIR, filename)) as z:
+                downloads.append({name: z.read(name) for name in z.namelist()})
+        assert len([name for name in downloads[0] if name.endswith(".docx")]) == 20
+        assert downloads[1] == downloads[0]
+
+
+class Upload:
+    def __init__(self, path, delay=0):
+        self.path = path
+        self.delay = delay
+
+    def save(self, dest):
+        time.sleep(self.delay)
+        shutil.copy(self.path, dest)
+
+
+def test_upload_dedup():
+    with tempfile.TemporaryDirectory() as root:
+        make_project(root, 5)
+        make_template(os.path.join(root, "style.docx"))
+        path = os.path.join(root, "upload.zip")
+        zip_project(root, path)
+        manager = FileSystemManager(os.path.join(root, "zip"), os.path.join(root, "download"))
+
+        # options are normalized before hashing: new words only count with a language, in any order
+        curly = [ApostrophePostProcessor("curly")]
+        key = manager.upload_key(path, pre_para_id="1", new_words="b a", post_processors=curly, seed=0)
+        assert key == manager.upload_key(path, pre_para_id=1, post_processors=curly, seed=0)
+        assert manager.upload_key(path, 1, lang="en-US", new_words="b a a") == \
+               manager.upload_key(path, 1, lang="en-US", new_words="a b")
+        for other in [dict(post_processors=[ApostrophePostProcessor("straight")]), dict(check=False), dict(seed=1)]:
+            assert manager.upload_key(path, 1, **{"post_processors": curly, "seed": 0, **other}) != key
+
+        # uploads received at the same time get names of their own
+        received = []
+        slow = Upload(path, delay=0.05)
+        threads = [threading.Thread(target=lambda: received.append(manager.receive(slow, "same.zip")))
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len({name for name, _ in received}) == 8
+        for _, saved in received:
+            os.remove(saved)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            jobs = JobQueue(concurrency=1)
+            release = threading.Event()
+            jobs.submit(lambda progress: release.wait(5))
+            # submitted again while waiting in line, the same upload joins the job already generating it
+            found, job = manager.submit(jobs, Upload(path), "upload.zip", 1, post_processors=curly, seed=0)
+            assert found is None and manager.submit(jobs, Upload(path), "upload.zip", "1", post_processors=curly,
+                                                    seed=0) == (None, job)
+            _, other = manager.submit(jobs, Upload(path), "upload.zip", 1, seed=0)
+            assert other is not job and len(os.listdir(manager.ZIP_DIR)) == 2
+            release.set()
+            jobs.shutdown()
+            assert job.state == other.state == 'done' and manager.find_result(key) == job.result
+
+            # once generated, the same upload is not generated again, and its copy is not kept
+            jobs = JobQueue()
+            assert manager.submit(jobs, Upload(path), "upload.zip", 1, post_processors=curly, seed=0) == \
+                   (job.result, None)
+            assert os.listdir(manager.ZIP_DIR) == []
+            # unless its download is gone
+            os.remove(os.path.join(manager.DOWNLOAD_DIR, job.result))
+            assert manager.find_result(key) is None
+            _, again = manager.submit(jobs, Upload(path), "upload.zip", 1, post_processors=curly, seed=0)
+            jobs.shutdown()
+            assert again.state == 'done' and manager.find_result(key) == again.result
+            assert os.path.exists(os.path.join(manager.DOWNLOAD_DIR, again.result))
+
+
+if __name__ == '__main__':
+    test_workers_reproducible()
+    test_parallel_check()
+    test_check_pieces()
+    test_write_to_archive()
+    test_zip_project()
+    test_zip_upload_workers()
+    test_upload_dedup()
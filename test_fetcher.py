@@ -0,0 +1,61 @@
+import os
+import tempfile
+from collections import Counter
+import numpy as np
+from fetcher import FlockFetcher, LeastUsedSampler, StudentFetcher
+
+
+def test_least_used_sampler():
+    np.random.seed(0)
+    sampler = LeastUsedSampler(5)
+    counts = Counter()
+    for i in range(23):
+        counts[sampler.draw()] += 1
+        assert max(counts.values()) - min(counts[k] for k in range(5)) <= 1
+        assert sampler.drained == ((i + 1) % 5 == 0)
+    assert sorted(counts.values()) == [4, 4, 5, 5, 5]
+
+
+def test_flock_sample():
+    np.random.seed(0)
+    with tempfile.TemporaryDirectory() as root:
+        os.makedirs(os.path.join(root, "overall"))
+        with open(os.path.join(root, "overall", "a.txt"), "w") as f:
+            f.write("Good.\n\nGreat.\n Good. \nFine.\n")
+        fetcher = FlockFetcher(root)
+        assert fetcher.get_possibilities("overall", "a") == ("Good.", "Great.", "Fine.")
+
+        rounds = [{fetcher.sample("overall", "a", mutex="x") for _ in range(3)} for _ in range(4)]
+        assert all(r == {"Good.", "Great.", "Fine."} for r in rounds)
+        assert fetcher.sample("overall", "a") in rounds[0]
+
+
+def test_student_rows():
+    with tempfile.TemporaryDirectory() as root:
+        with open(os.path.join(root, "eval.csv"), "w") as f:
+            f.write("first_name,last_name,gender,assignment,participation,final,overall,note\n"
+                    " ada , lovelace,f,a,B ,c,d,hi\n"
+                    "émile,zola,M,A,B,C,D,5\n"
+                    "x,y,X,A,B,C,E,5\n")
+        fetcher = StudentFetcher(root, "eval.csv", flock_fetcher=None, chunksize=2)
+        frames = fetcher.read_frames(chunksize=2)
+        assert list(fetcher.iter_rows(next(frames))) == [
+            {'first_name': 'Ada', 'last_name': 'Lovelace', 'gender': 'F', 'assignment': 'A', 'participation': 'B',
+             'final': 'C', 'overall': 'D', 'note': 'hi'},
+            {'first_name': 'émile', 'last_name': 'Zola', 'gender': 'M', 'assignment': 'A', 'participation': 'B',
+             'final': 'C', 'overall': 'D', 'note': '5'},
+        ]
+        try:
+            next(frames)
+        except ValueError as e:
+            print(e)
+            assert "line 4: unknown gender 'X'" in str(e) and "line 4: unknown overall grade 'E'" in str(e)
+        else:
+            raise AssertionError("invalid rows should be reported")
+        assert fetcher.collect_names() == ({'Ada', 'émile', 'X'}, {'Lovelace', 'Zola', 'Y'})
+
+
+if __name__ == '__main__':
+    test_least_used_sampler()
+    test_flock_sample()
+    test_student_rows()
@@ -0,0 +1,121 @@
+import tempfile
+import time
+import language_tool_python as langtool
+from langtool_stub import StubServer
+from grammar import GrammarChecker, GrammarCache, LanguageToolError, mask_names, unmask_names
+
+server = StubServer(latency=0.01, fail_every=3).start()
+tool = langtool.LanguageTool('en-US', remote_server=server.url)
+
+
+def test_iter_check():
+    checker = GrammarChecker(tool, concurrency=4, backoff=0.01)
+    texts = [f"Letter {i}: teh student did did well." for i in range(20)]
+    results = list(checker.iter_check(enumerate(texts)))
+
+    assert [i for i, _, _ in results] == list(range(20))
+    for i, text, matches in results:
+        assert text == texts[i]
+        assert [m.rule_id for m in matches] == ["MORFOLOGIK_RULE_EN_US", "ENGLISH_WORD_REPEAT_RULE"]
+        assert langtool.utils.correct(text, matches) == f"Letter {i}: the student did well."
+    # every failed request was retried, over no more connections than workers
+    assert server.n_checks > 20
+    assert len(server.clients) <= 4
+
+
+def test_retries_exhausted():
+    checker = GrammarChecker(tool, retries=0)
+    server.n_checks = 2
+    try:
+        checker.check("teh")
+    except LanguageToolError as e:
+        assert "503" in str(e)
+    else:
+        raise AssertionError("a 503 without retries should raise")
+
+
+def test_segments():
+    clean_server = StubServer().start()
+    clean_tool = langtool.LanguageTool('en-US', remote_server=clean_server.url)
+    names = ["Ada Lovelace", "Bob Smith", "Cy Young", "Dee Lovelace"]
+    pairs = [(name.split(), f"Dear committee,\n\n{name} did did well. teh {name.split()[0]}!\nSincerely, me\n")
+             for name in names]
+    whole = list(GrammarChecker(clean_tool).iter_check(pairs))
+    n_checks = clean_server.n_checks
+    segmented = list(GrammarChecker(clean_tool, segment='sentence').iter_check(pairs, names=lambda item: item))
+    # the greeting and closing once each, the names masked by initial and length: 4 (first, last) and 3 first names
+    assert clean_server.n_checks - n_checks == 2 + 4 + 3
+
+    for (_, text, expected), (item, _, matches) in zip(whole, segmented):
+        assert [(m.offset, m.error_length, m.replacements) for m in matches] == \
+               [(m.offset, m.error_length, m.replacements) for m in expected]
+        assert langtool.utils.correct(text, matches) == \
+               f"Dear committee,\n\n{' '.join(item)} did well. the {item[0]}!\nSincerely, me\n"
+        assert all(m.context in text and m.sentence in text for m in matches)
+
+    # a context cut in the middle of a name still shows the student's name, not its stand-in
+    text = "Zorb Quix did did well in teh class."
+    (_, _, matches), = GrammarChecker(clean_tool, segment='sentence').iter_check([(None, text)],
+                                                                                  names=lambda item: ("Zorb", "Quix"))
+    assert [(m.context, m.sentence) for m in matches] == [(text, text), (text[6:], text)]
+    clean_server.shutdown()
+
+
+def test_mask_names():
+    text = "Ask a Bob or an Ada about it, not an Ada."
+    masked, replaced = mask_names(text, ("Bob", "Smith"))
+    # "a" and "an" still fit the stand-ins
+    assert masked == "Ask a Ben or an Ada about it, not an Ada." and unmask_names(masked, replaced) == text
+    masked, replaced = mask_names(text, ("Ada", "Smith"))
+    assert masked == "Ask a Bob or an Ann about it, not an Ann." and unmask_names(masked, replaced) == text
+
+
+def test_cache():
+    clean_server = StubServer().start()
+    clean_tool = langtool.LanguageTool('en-US', remote_server=clean_server.url)
+    texts = [f"Letter {i}: teh end." for i in range(10)]
+    with tempfile.TemporaryDirectory() as root:
+        cache = GrammarCache(root)
+        first = list(GrammarChecker(clean_tool, cache=cache, new_spellings=["Ada"]).iter_check(enumerate(texts)))
+        assert cache.stats()["misses"] == 10 and cache.stats()["hits"] == 0
+
+        n_checks = clean_server.n_checks
+        cache = GrammarCache(root)
+        again = list(GrammarChecker(clean_tool, cache=cache, new_spellings=["Ada"]).iter_check(enumerate(texts)))
+        assert clean_server.n_checks == n_checks + 1  # only the server version is asked for
+        assert [[str(m) for m in ms] for _, _, ms in again] == [[str(m) for m in ms] for _, _, ms in first]
+        assert cache.stats()["hits"] == 10
+
+        # writing over an entry only counts its new size
+        size = cache.stats()["bytes"]
+        cache.put("0" * 64, ["x"])
+        cache.put("0" * 64, ["x"])
+        assert cache.stats()["bytes"] == size + len(b'["x"]')
+
+        # other spellings make other keys
+        GrammarChecker(clean_tool, cache=cache, new_spellings=["Bob"]).check(texts[0])
+        assert cache.stats()["misses"] == 1
+
+        # the least recently used entries go first once the cache is full
+        small = GrammarCache(root, max_bytes=cache.stats()["bytes"])
+        checker = GrammarChecker(clean_tool, cache=small, new_spellings=["Ada"])
+        checker.check(texts[0])
+        checker.check("Something new.")
+        assert small.evictions > 0 and small.stats()["bytes"] <= small.max_bytes
+        checker.check(texts[0])
+        assert small.stats()["hits"] == 2
+
+        # expired entries are misses
+        expired = GrammarCache(root, ttl=0)
+        time.sleep(0.01)
+        GrammarChecker(clean_tool, cache=expired, new_spellings=["Ada"]).check(texts[0])
+        assert expired.stats()["hits"] == 0 and expired.evictions == 1
+    clean_server.shutdown()
+
+
+if __name__ == '__main__':
+    test_iter_check()
+    test_retries_exhausted()
+    test_segments()
+    test_mask_names()
+    test_cache()
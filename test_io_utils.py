@@ -0,0 +1,55 @@
+import os
+import pickle
+import tempfile
+import contextlib
+import io
+from docx import Document
+import zipfile
+from io_utils import DocxInsertionWriter, ZipFileSystem, read_docxfile
+from fixtures import make_template
+
+
+def test_docx_insertion():
+    with tempfile.TemporaryDirectory() as root, contextlib.redirect_stdout(io.StringIO()):
+        template = os.path.join(root, "style.docx")
+        make_template(template)
+        content = "Dear committee,\n\tI recommend Ada.\n"
+        letter = ["Dear committee,", "\tI recommend Ada.", ""]
+        for insert_before, expected in [(True, ["Letterhead"] + letter + ["Signature"]),
+                                        (False, ["Letterhead", "Signature"] + letter)]:
+            writer = DocxInsertionWriter(template, pre_para_id=1, insert_before=insert_before)
+            writer.write(content, os.path.join(root, "a"))
+            # the template is prepared once, and unpickled writers prepare it again
+            pickle.loads(pickle.dumps(writer)).write(content, os.path.join(root, "b"))
+            writer.write("Another letter", os.path.join(root, "c"))
+
+            assert read_docxfile(os.path.join(root, "a.docx")).split("\n") == expected + ["Footer"]
+            assert read_docxfile(os.path.join(root, "c.docx")).split("\n")[:2] == \
+                   (["Letterhead", "Another letter"] if insert_before else ["Letterhead", "Signature"])
+            with open(os.path.join(root, "a.docx"), "rb") as a, open(os.path.join(root, "b.docx"), "rb") as b:
+                assert a.read() == b.read()
+            assert Document(os.path.join(root, "a.docx")).styles['Normal'].font.name == 'Times New Roman'
+
+
+def test_zip_file_system():
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, "w") as z:
+        z.writestr("genre/genre.txt", "Dear __first_name__,\r\nSincerely")
+        z.writestr("eval.csv", "x" * 101)
+        z.writestr("flock/", "")
+    fs = ZipFileSystem(data.getvalue(), max_member_size=100)
+    assert fs.read_text(os.path.join("genre", "genre.txt")) == "Dear __first_name__,\nSincerely"
+    assert fs.isfile("./genre/genre.txt") and not fs.isfile("genre") and not fs.isfile("flock")
+    for path, error in [("genre/missing.txt", FileNotFoundError), ("eval.csv", ValueError)]:
+        try:
+            fs.read_bytes(path)
+        except error:
+            pass
+        else:
+            raise AssertionError(f"reading {path} should raise {error.__name__}")
+    assert pickle.loads(pickle.dumps(fs)).read_bytes("genre/genre.txt") == fs.read_bytes("genre/genre.txt")
+
+
+if __name__ == '__main__':
+    test_docx_insertion()
+    test_zip_file_system()
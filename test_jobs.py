@@ -0,0 +1,70 @@
+import threading
+import time
+from jobs import JobQueue, QueueFull
+
+
+def test_job_queue():
+    queue = JobQueue(concurrency=1, max_queued=1, keep=2)
+    release = threading.Event()
+
+    def task(n, progress):
+        progress('waiting', 0, n)
+        release.wait(5)
+        if n < 0:
+            raise ValueError("negative")
+        progress('counting', n, n)
+        return n * 2
+
+    first = queue.submit(task, 3)
+    while first.to_dict()['stage'] != 'waiting':
+        time.sleep(0.001)
+    assert first.state == 'running'
+    second = queue.submit(task, -1)
+    # one running and one waiting: the queue is full
+    try:
+        queue.submit(task, 1)
+    except QueueFull:
+        pass
+    else:
+        raise AssertionError("a full queue should refuse jobs")
+
+    release.set()
+    queue.shutdown()
+    assert first.to_dict()['state'] == 'done' and first.result == 6 and (first.done, first.total) == (3, 3)
+    assert second.state == 'failed' and second.error == "negative" and "ValueError" in second.traceback
+
+    # finished jobs are forgotten once `keep` more recent ones finished
+    queue = JobQueue(keep=2)
+    finished = [queue.submit(task, i) for i in range(3)]
+    queue.shutdown()
+    assert [queue.get(job.id) for job in finished] == [None] + finished[1:]
+
+
+def test_submit_once():
+    queue = JobQueue(concurrency=1, max_queued=4)
+    release = threading.Event()
+    calls = []
+
+    def task(n, progress):
+        calls.append(n)
+        release.wait(5)
+        return n
+
+    first, submitted = queue.submit_once("a", task, 1)
+    assert submitted
+    assert queue.submit_once("a", task, 2) == (first, False)
+    other, submitted = queue.submit_once("b", task, 3)
+    assert submitted and other is not first
+    release.set()
+    queue.shutdown()
+    assert calls == [1, 3] and first.result == 1
+    # once through, the key is free again
+    queue = JobQueue()
+    again, submitted = queue.submit_once("a", task, 4)
+    queue.shutdown()
+    assert submitted and again.result == 4
+
+
+if __name__ == '__main__':
+    test_job_queue()
+    test_submit_once()
@@ -0,0 +1,61 @@
+import warnings
+from parser import Parser, split_sentences
+from blob import Paragraph, SentenceSlot, ParagraphSlot, HePlaceholder
+
+parser = Parser()
+
+
+def test_parse_paragraph():
+    p = parser.parse_paragraph("__he__ did well.  it was__his__ best. __sent_a__ Done. really")
+    assert isinstance(p, Paragraph)
+    assert [type(s).__name__ for s in p.entries] == ["Sentence", "Sentence", "SentenceSlot", "Sentence", "Sentence"]
+    assert isinstance(p.entries[0].entries[0], HePlaceholder)
+    print(repr(p))
+
+    filled = p.fill({"he": parser.parse_word("she"), "his": parser.parse_word("her"),
+                     "sent_a": parser.parse_sentence("And more.")})
+    assert filled.serialize() == "She did well. It washer best. And more. Done. Really"
+    assert parser.parse_paragraph("__para_x__").__class__ is ParagraphSlot
+
+
+def test_parse_sentence():
+    s = parser.parse_sentence("Prof. __first_name__ __last_name__,  PhD")
+    assert s.fill({"first_name": parser.parse_word("ada"), "last_name": parser.parse_word("lovelace")}).serialize() \
+        == "Prof. Ada Lovelace, PhD"
+    assert isinstance(parser.parse_sentence("__sent_a__"), SentenceSlot)
+    for bad in [" __sent_a__", "x __sent_a__", "a\tb", "__a____b__x"]:
+        try:
+            parser.parse_sentence(bad)
+        except ValueError:
+            continue
+        raise AssertionError(f"{bad!r} should not parse")
+
+
+def test_ambiguous_underscores():
+    # runs of underscores are resolved the way the per-level regexes always did
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        assert repr(parser.parse_sentence("fill in ____.")) == repr(parser._parse_sentence_by_regex("fill in ____."))
+        assert repr(parser.parse_paragraph("a__.__b. c")) == repr(parser._parse_paragraph_by_regex("a__.__b. c"))
+        # a sentence tag that starts at a tag's closing "__"
+        assert len(parser.parse_paragraph("__his__sent_.__he__").entries) == 3
+
+
+def test_many_sentence_tags():
+    s = " ".join(f"__sent_{i}__" for i in range(2000))
+    assert len(split_sentences(s)) == 2000
+    assert len(parser.parse_paragraph(s).entries) == 2000
+    # sentence tags are still checked for whitespace
+    for bad in ["I like __sent_x. y__ a lot.", "foo__sent_x.b  Heb__", "__sent__ __first_name__a."]:
+        try:
+            parser.parse_paragraph(bad)
+        except ValueError:
+            continue
+        raise AssertionError(f"{bad!r} should not parse")
+
+
+if __name__ == '__main__':
+    test_parse_paragraph()
+    test_parse_sentence()
+    test_ambiguous_underscores()
+    test_many_sentence_tags()